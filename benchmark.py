@@ -0,0 +1,241 @@
+import sys
+import json
+import time
+import random
+import argparse
+import subprocess
+import logging
+import platform
+from pathlib import Path
+
+import tibskritconv
+import normalize_unicode
+
+TEST_FILE = Path(__file__).parent.joinpath("tests", "D4155.txt")
+
+def best_time(f, *args, repeat=5):
+    ''' Returns the best time in seconds of repeat calls to f(*args)'''
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f(*args)
+        t = time.perf_counter() - start
+        if best is None or t < best:
+            best = t
+    return best
+
+def compare(name, reference, optimized, *args, repeat=5):
+    tref = best_time(reference, *args, repeat=repeat)
+    topt = best_time(optimized, *args, repeat=repeat)
+    print("%-34s %8.1f ms -> %8.1f ms (x%.1f)" % (name, tref * 1000, topt * 1000, tref / topt))
+
+def bench_reorder(s):
+    compare("tibskritconv.unicode_reorder", tibskritconv.unicode_reorder_reference, tibskritconv.unicode_reorder, s)
+    compare("normalize_unicode.unicode_reorder", normalize_unicode.unicode_reorder_reference, normalize_unicode.unicode_reorder, s)
+
+def bench_normalize(s):
+    compare("tibskritconv.normalize_unicode", tibskritconv.normalize_unicode_reference, tibskritconv.normalize_unicode, s)
+    for form in ["nfd", "nfc"]:
+        compare("normalize_unicode (%s)" % form, normalize_unicode.normalize_unicode_reference, normalize_unicode.normalize_unicode, s, form)
+
+def bench_convert(s):
+    # the reference is slow on big texts
+    compare("tibskrit_to_iast", tibskritconv.tibskrit_to_iast_reference, tibskritconv.tibskrit_to_iast, s, repeat=1)
+    print("syllable cache: %s" % str(tibskritconv.CONVERTER.cache_info()))
+
+def convert_with_automaton(s):
+    state = tibskritconv.StateAutomaton()
+    tibskritconv.convert_chars(state, s)
+    return state.get_result()
+
+def convert_with_dfa(s):
+    return tibskritconv.get_dfa().run(s)
+
+def bench_scaling(s, factors):
+    ''' Converts concatenations of s, the time per character should stay the same'''
+    norm = tibskritconv.normalize_unicode(s)
+    for n in factors:
+        tauto = best_time(convert_with_automaton, norm * n, repeat=1)
+        tconv = best_time(tibskritconv.tibskrit_to_iast, s * n, repeat=1)
+        print("x%-4d %9d chars: automaton %8.1f ms (%.2f us/char), tibskrit_to_iast %8.1f ms (%.2f us/char)"
+              % (n, len(s) * n, tauto * 1000, tauto * 1e6 / (len(s) * n), tconv * 1000, tconv * 1e6 / (len(s) * n)))
+
+# synthetic corpora, of about the size of the test file
+
+def stacks_corpus(size=400000):
+    ''' Big stacks: base, 2 or 3 subscripts, vowels and marks in random order'''
+    rnd = random.Random(0)
+    bases = [chr(c) for c in range(0x0F40, 0x0F6A)]
+    subscripts = [chr(c) for c in range(0x0F90, 0x0FBC) if chr(c) in tibskritconv.CHAR_TOKENS]
+    marks = ["\u0f71", "\u0f72", "\u0f74", "\u0f7a", "\u0f7c", "\u0f7e", "\u0f7f", "\u0f80", "\u0f84"]
+    res = []
+    n = 0
+    while n < size:
+        stack = [rnd.choice(bases)] + rnd.sample(subscripts, rnd.randint(2, 3)) + rnd.sample(marks, rnd.randint(1, 3))
+        # marks and subscripts are not always in the canonical order
+        tail = stack[1:]
+        rnd.shuffle(tail)
+        res.append(stack[0] + "".join(tail) + "་")
+        n += len(stack) + 1
+    return "".join(res)
+
+def no_tsheg_corpus(s):
+    ''' Long runs without tsheg, the syllable cache doesn't help'''
+    return s.replace("་", "")
+
+def non_sanskrit_corpus(size=400000):
+    ''' Folio markers, Latin markup and Tibetan that can't be converted'''
+    rnd = random.Random(0)
+    words = ["[1b.%d]" % i for i in range(1, 8)] + ["<note>", "</note>", "{D4155}", "lorem", "ipsum", "ཞ", "ཟ", "འ", "ཞི", "ཟླ", "འོ"]
+    res = []
+    n = 0
+    while n < size:
+        w = rnd.choice(words) + rnd.choice([" ", "་", "\n"])
+        res.append(w)
+        n += len(w)
+    return "".join(res)
+
+def corpora():
+    s = TEST_FILE.read_text(encoding="utf-8")
+    return {
+        "D4155": s,
+        "stacks": stacks_corpus(),
+        "no-tsheg": no_tsheg_corpus(s),
+        "non-sanskrit": non_sanskrit_corpus(),
+        }
+
+def run_tibskrit_to_iast(s):
+    # measure the conversion of one document, not a warm cache
+    tibskritconv.CONVERTER.cache_clear()
+    tibskritconv.tibskrit_to_iast(s)
+
+def run_tibskrit_to_schemes(s):
+    tibskritconv.SCHEME_CONVERTERS.clear()
+    tibskritconv.tibskrit_to_schemes(s)
+
+# name: (function to measure, preparation of the corpus)
+BENCHMARKS = {
+    "normalize_unicode": (tibskritconv.normalize_unicode, None),
+    "unicode_reorder": (tibskritconv.unicode_reorder, lambda s: s.translate(tibskritconv.DECOMPOSITIONS)),
+    "StateAutomaton": (convert_with_automaton, tibskritconv.normalize_unicode),
+    "TransliterationDFA": (convert_with_dfa, tibskritconv.normalize_unicode),
+    "tibskrit_to_iast": (run_tibskrit_to_iast, None),
+    "tibskrit_to_schemes": (run_tibskrit_to_schemes, None),
+    }
+if tibskritconv.import_numpy() is not None:
+    BENCHMARKS["normalize_unicode[numpy]"] = (lambda s: tibskritconv.normalize_unicode(s, "numpy"), None)
+    BENCHMARKS["unicode_reorder[numpy]"] = (lambda s: tibskritconv.unicode_reorder(s, "numpy"), lambda s: s.translate(tibskritconv.DECOMPOSITIONS))
+
+def run_suite(repeat=3, names=None):
+    ''' Returns {"benchmark/corpus": {"seconds": ..., "chars_per_s": ...}} for all benchmarks on all corpora'''
+    results = {}
+    for corpus, text in corpora().items():
+        for name, (f, prepare) in BENCHMARKS.items():
+            if names and name not in names:
+                continue
+            s = prepare(text) if prepare else text
+            t = best_time(f, s, repeat=repeat)
+            key = "%s/%s" % (name, corpus)
+            results[key] = {"chars": len(s), "seconds": t, "chars_per_s": len(s) / t}
+            print("%-32s %9d chars %8.1f ms %12.0f chars/s" % (key, len(s), t * 1000, len(s) / t))
+    return results
+
+# startup of short-lived processes converting one text
+
+IMPORT_BUDGET = 0.1
+# modules that are only imported by the functions that use them
+LAZY_IMPORTS = ["concurrent.futures", "multiprocessing", "argparse", "tempfile", "json", "numpy"]
+
+def import_times(module):
+    ''' Returns {module: cumulative import time in seconds} of the modules imported
+    by module in a new interpreter, from python -X importtime'''
+    res = subprocess.run([sys.executable, "-X", "importtime", "-c", "import %s" % module],
+                         capture_output=True, text=True, cwd=Path(__file__).parent, check=True)
+    times = {}
+    for line in res.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            times[parts[2].strip()] = int(parts[1]) / 1e6
+    return times
+
+def run_python(code):
+    subprocess.run([sys.executable, "-c", code], cwd=Path(__file__).parent, check=True)
+
+def run_startup(repeat=3):
+    ''' Returns {"import/tibskritconv": ..., "startup/tibskritconv": ...} and the modules of
+    LAZY_IMPORTS imported by tibskritconv. The startup is the time to import and convert
+    one line, without the start of the interpreter.'''
+    times = [import_times("tibskritconv") for _ in range(repeat)]
+    timport = min(t["tibskritconv"] for t in times)
+    tpython = best_time(run_python, "pass", repeat=repeat)
+    tstartup = best_time(run_python, "import tibskritconv; tibskritconv.tibskrit_to_iast('ཀརྨ')", repeat=repeat) - tpython
+    results = {"import/tibskritconv": {"seconds": timport}, "startup/tibskritconv": {"seconds": tstartup}}
+    for key, res in results.items():
+        print("%-32s %8.1f ms" % (key, res["seconds"] * 1000))
+    return results, [m for m in LAZY_IMPORTS if m in times[0]]
+
+def check_regressions(results, baseline, threshold):
+    ''' Returns the benchmarks with a throughput (or the inverse of the time if there
+    is no throughput) lower than (1 - threshold) times the baseline'''
+    regressions = []
+    for key, res in results.items():
+        if key not in baseline:
+            continue
+        if "chars_per_s" in res:
+            ratio = res["chars_per_s"] / baseline[key]["chars_per_s"]
+        else:
+            ratio = baseline[key]["seconds"] / res["seconds"]
+        if ratio < 1 - threshold:
+            regressions.append((key, ratio))
+    return regressions
+
+BASELINE_FILE = Path(__file__).parent.joinpath("bench_baseline.json")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark suite, on %s and synthetic corpora" % TEST_FILE.name)
+    parser.add_argument("--scaling", type=int, nargs="*", metavar="N", help="only convert N concatenations of the file (default: 1 10 100)")
+    parser.add_argument("--compare", action="store_true", help="only compare with the reference implementations")
+    parser.add_argument("-b", "--benchmark", action="append", choices=list(BENCHMARKS), help="only run these benchmarks")
+    parser.add_argument("-r", "--repeat", type=int, default=3, help="number of runs, the best is kept (default: 3)")
+    parser.add_argument("-o", "--output", type=Path, help="write the results in this JSON file")
+    parser.add_argument("--baseline", type=Path, default=BASELINE_FILE, help="JSON results to compare to (default: %s, if it exists)" % BASELINE_FILE.name)
+    parser.add_argument("--threshold", type=float, default=0.2, help="fail if a throughput is lower than the baseline by this ratio (default: 0.2)")
+    parser.add_argument("--import-budget", type=float, default=IMPORT_BUDGET * 1000, help="fail if importing tibskritconv takes more milliseconds (default: %d)" % (IMPORT_BUDGET * 1000))
+    args = parser.parse_args()
+    # diagnostics are not what is measured
+    logging.disable(logging.CRITICAL)
+    s = TEST_FILE.read_text(encoding="utf-8")
+    if args.scaling is not None:
+        print("%s: %d characters" % (TEST_FILE.name, len(s)))
+        bench_scaling(s, args.scaling or [1, 10, 100])
+        sys.exit(0)
+    if args.compare:
+        print("%s: %d characters" % (TEST_FILE.name, len(s)))
+        bench_reorder(s)
+        bench_normalize(s)
+        bench_convert(s)
+        sys.exit(0)
+    results = run_suite(args.repeat, args.benchmark)
+    failed = False
+    if not args.benchmark:
+        startup, eager = run_startup(args.repeat)
+        results.update(startup)
+        if startup["import/tibskritconv"]["seconds"] * 1000 > args.import_budget:
+            print("OVER BUDGET: importing tibskritconv takes more than %d ms" % args.import_budget)
+            failed = True
+        if eager:
+            print("EAGER IMPORTS: tibskritconv imports %s at import time" % ", ".join(eager))
+            failed = True
+    if args.output:
+        args.output.write_text(json.dumps({"python": platform.python_version(), "results": results}, indent=2), encoding="utf-8")
+    if args.baseline.exists():
+        baseline = json.loads(args.baseline.read_text(encoding="utf-8"))["results"]
+        regressions = check_regressions(results, baseline, args.threshold)
+        for key, ratio in regressions:
+            print("REGRESSION %s: %.0f%% of the baseline throughput" % (key, ratio * 100))
+        if regressions:
+            failed = True
+        else:
+            print("no regression compared to %s" % args.baseline)
+    if failed:
+        sys.exit(1)
@@ -0,0 +1,209 @@
+import sys
+import time
+import random
+import argparse
+import logging
+
+import tibskritconv
+import normalize_unicode
+from tibskrittables import unicode_reorder, unicode_reorder_reference, import_numpy
+
+# Differential tests of the normalization and of the conversion against the
+# straightforward reference implementations, on random sequences of Tibetan
+# code points, and a check that the time of the conversion stays linear.
+# With Hypothesis (if installed) the failing examples are shrunk by it,
+# else random sequences are generated and shrunk by shrink().
+#
+# The reference implementations share StateAutomaton with the optimized
+# engines, so its quirks (the condition before finishing the aksara on a
+# base r or l is always true) are not differences: they are what the DFA
+# and the syllable cache must reproduce.
+
+# stacks are what the normalization reorders, so most characters are
+# bases and marks; the rest of the block (including unassigned code
+# points) and a few non-Tibetan characters are less frequent
+BASES = [chr(c) for c in range(0x0F40, 0x0F6D)]
+MARKS = [chr(c) for c in range(0x0F71, 0x0F88)] + [chr(c) for c in range(0x0F8D, 0x0FBD)]
+OTHERS = [chr(c) for c in range(0x0F00, 0x0F40)] + [chr(c) for c in range(0x0FBE, 0x0FDB)]
+NON_TIBETAN = ["\n", " ", "a", "[", "1", ".", "]"]
+ALPHABET = BASES + MARKS + OTHERS + NON_TIBETAN
+# (characters, weight)
+GROUPS = [(BASES, 4), (MARKS, 5), (OTHERS, 1), (["་", "།"], 2), (NON_TIBETAN, 1)]
+
+def random_text(rnd, size):
+    groups = rnd.choices([chars for chars, _ in GROUPS], [weight for _, weight in GROUPS], k=size)
+    return "".join(rnd.choice(chars) for chars in groups)
+
+def check_normalize(s):
+    expected = tibskritconv.normalize_unicode_reference(s)
+    assert tibskritconv.normalize_unicode(s) == expected, "normalize_unicode"
+    for form in ["nfd", "nfc"]:
+        assert normalize_unicode.normalize_unicode(s, form) == normalize_unicode.normalize_unicode_reference(s, form), "normalize_unicode (%s)" % form
+    # the valid flag (no mark outside of a stack) is part of the result
+    assert unicode_reorder(s) == unicode_reorder_reference(s), "unicode_reorder"
+    if import_numpy() is not None:
+        assert tibskritconv.normalize_unicode(s, "numpy") == expected, "normalize_unicode[numpy]"
+        assert unicode_reorder(s, "numpy") == unicode_reorder_reference(s), "unicode_reorder[numpy]"
+
+def check_convert(s):
+    expected = tibskritconv.tibskrit_to_iast_reference(s)
+    report = tibskritconv.ConversionReport()
+    assert tibskritconv.tibskrit_to_iast(s, report) == expected, "tibskrit_to_iast"
+    assert tibskritconv.tibskrit_to_iast_with_offsets(s)[0] == expected, "tibskrit_to_iast_with_offsets"
+    assert tibskritconv.tibskrit_to_schemes(s, ["iast"], tibskritconv.ConversionReport())["iast"] == expected, "tibskrit_to_schemes"
+    norm = tibskritconv.normalize_unicode(s)
+    state = tibskritconv.StateAutomaton()
+    tibskritconv.convert_chars(state, norm)
+    assert tibskritconv.get_dfa().run(norm) == (state.get_result(), state.diagnostics), "TransliterationDFA"
+    # same problems at the same offsets of the normalized text
+    expected_report = tibskritconv.ConversionReport()
+    expected_report.add(state.diagnostics)
+    assert report.offsets == expected_report.offsets, "diagnostics"
+
+def check(s):
+    check_normalize(s)
+    check_convert(s)
+
+def failure(s):
+    ''' Returns the exception and the message of the check that fails on s, None if they
+    all pass. An exception in an engine is a failure too.'''
+    try:
+        check(s)
+    except Exception as e:
+        return "%s: %s" % (type(e).__name__, e)
+    return None
+
+def shrink(s, message):
+    ''' Returns a shorter string failing with the same message, removing chars while it fails'''
+    i = 0
+    while i < len(s):
+        t = s[:i] + s[i + 1:]
+        if failure(t) == message:
+            s = t
+        else:
+            i += 1
+    return s
+
+def describe(s, message):
+    return "%s on %s (%s)" % (message, ascii(s), " ".join("%04x" % ord(c) for c in s))
+
+def report_failure(s, message):
+    print("FAILED %s" % describe(shrink(s, message), message))
+
+def fuzz_random(nb, max_len, seed):
+    ''' Checks nb random texts of up to max_len chars, returns the number of failures'''
+    rnd = random.Random(seed)
+    failures = 0
+    for _ in range(nb):
+        s = random_text(rnd, rnd.randint(0, max_len))
+        message = failure(s)
+        if message is not None:
+            report_failure(s, message)
+            failures += 1
+    return failures
+
+def fuzz_hypothesis(nb, max_len):
+    from hypothesis import given, settings, strategies as st
+    @settings(max_examples=nb, deadline=None, database=None)
+    @given(st.text(alphabet=st.sampled_from(ALPHABET), max_size=max_len))
+    def test(s):
+        # the message of the shrunk example is the one raised at the end
+        message = failure(s)
+        assert message is None, describe(s, message)
+    try:
+        test()
+    except AssertionError as e:
+        print("FAILED %s" % e)
+        return 1
+    return 0
+
+# Performance cliffs: each input is repeated to make texts of SCALING_SIZE
+# chars and SCALING_FACTOR times more, the time per char must not grow more
+# than SUPERLINEAR_RATIO times.
+SCALING_SIZE = 20000
+SCALING_FACTOR = 8
+SUPERLINEAR_RATIO = 2.5
+
+# inputs that could be slow: long stacks, marks without a base (one run
+# of the size of the text), lines without tsheg, spaced non-Tibetan text
+PATHOLOGICAL = {
+    "long stack": "ཀ" + "".join(MARKS),
+    "repeated mark": "ཀ" + "ེ" * 100,
+    "marks only": "ྲེ",
+    "repeated aa": "ཱྰ" * 50,
+    "no tsheg": "ཀྲྀཏཱུ",
+    "spaced latin": "a " * 50 + "ཀ",
+    "spaces": " " * 100 + "ཀ",
+    "orphan marks": "ིཾྀ",
+    "subscripts": "".join(MARKS[30:]),
+    }
+
+def convert(s):
+    tibskritconv.CONVERTER.cache_clear()
+    tibskritconv.tibskrit_to_iast(s, tibskritconv.ConversionReport())
+
+SCALED_FUNCTIONS = {
+    "normalize_unicode": tibskritconv.normalize_unicode,
+    "tibskrit_to_iast": convert,
+    }
+
+def time_per_char(f, s, repeat=3):
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f(s)
+        t = time.perf_counter() - start
+        if best is None or t < best:
+            best = t
+    return best / len(s)
+
+def check_scaling(unit, size=SCALING_SIZE, factor=SCALING_FACTOR):
+    ''' Returns {function: ratio of the time per char on unit repeated to size * factor
+    chars and to size chars}'''
+    s = unit * max(1, size // len(unit))
+    res = {}
+    for name, f in SCALED_FUNCTIONS.items():
+        res[name] = time_per_char(f, s * factor) / time_per_char(f, s)
+    return res
+
+def fuzz_scaling(nb, seed):
+    ''' Checks the scaling on PATHOLOGICAL and nb random inputs, returns the number of
+    super-linear ones'''
+    rnd = random.Random(seed)
+    inputs = dict(PATHOLOGICAL)
+    for i in range(nb):
+        inputs["random %d" % i] = random_text(rnd, 200)
+    failures = 0
+    for name, unit in inputs.items():
+        ratios = check_scaling(unit)
+        for f, ratio in ratios.items():
+            if ratio > SUPERLINEAR_RATIO:
+                print("SUPER-LINEAR %s on %s: x%.1f time per char for x%d chars (%s)" % (f, name, ratio, SCALING_FACTOR, ascii(unit)))
+                failures += 1
+        print("%-16s %s" % (name, ", ".join("%s x%.2f" % (f, ratio) for f, ratio in ratios.items())))
+    return failures
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Differential fuzzing of the normalization and conversion against the reference implementations, and scaling check")
+    parser.add_argument("-n", "--examples", type=int, default=2000, help="number of random texts (default: 2000)")
+    parser.add_argument("--max-len", type=int, default=40, help="maximum length of the random texts (default: 40)")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the random texts, without Hypothesis (default: 0)")
+    parser.add_argument("--no-hypothesis", action="store_true", help="generate random texts even if Hypothesis is installed")
+    parser.add_argument("--scaling", type=int, nargs="?", const=5, metavar="N", help="also check the scaling on the pathological inputs and N random ones (default: 5)")
+    args = parser.parse_args()
+    # the reference implementations log each problem
+    logging.disable(logging.CRITICAL)
+    try:
+        if args.no_hypothesis:
+            raise ImportError
+        import hypothesis
+        print("fuzzing with Hypothesis %s" % hypothesis.__version__)
+        failures = fuzz_hypothesis(args.examples, args.max_len)
+    except ImportError:
+        print("fuzzing with random texts, seed %d" % args.seed)
+        failures = fuzz_random(args.examples, args.max_len, args.seed)
+    print("%d texts, %d failures" % (args.examples, failures))
+    if args.scaling is not None:
+        failures += fuzz_scaling(args.scaling, args.seed)
+    if failures:
+        sys.exit(1)
@@ -1,93 +1,65 @@
 import re
-from enum import Enum
+from pathlib import Path
 
-class Cats(Enum):
-    Other = 0
-    Base = 1
-    Subscript = 2
-    BottomVowel = 3
-    BottomMark = 4
-    TopVowel = 5
-    TopMark = 6
-    RightMark = 7
+from tibskrittables import DISCOURAGED, RUN_RE, normalize_run_match, unicode_reorder_reference, numpy_normalizer, import_numpy
+# defined here before the tables moved to tibskrittables, kept for compatibility
+from tibskrittables import OrderCats as Cats, CATEGORIES, charcat, unicode_reorder
 
-CATEGORIES =  ([Cats.Other]           # 0F00
-             + [Cats.Base]            # 0F01, often followed by 0f083
-             + [Cats.Other] * 22      # 0F02-0F17
-             + [Cats.BottomVowel] * 2 # 0F18-0F19
-             + [Cats.Other] * 6       # 0F1A-0F1F
-             + [Cats.Base] * 20       # 0F20-0F33, numbers can be followed by 0f18, 0f19 or exceptionally by vowels
-             + [Cats.Other]           # 0F34
-             + [Cats.BottomMark]      # 0F35
-             + [Cats.Other]           # 0F36
-             + [Cats.BottomMark]      # OF37
-             + [Cats.Other]           # 0F38
-             + [Cats.Subscript]       # 0F39, kind of cheating but works
-             + [Cats.Other] * 4       # 0F3A-0F3D
-             + [Cats.RightMark]       # 0F3E
-             + [Cats.Other]           # 0F3F, not quite sure
-             + [Cats.Base] * 45       # 0F40-0F6C
-             + [Cats.Other] * 4       # 0F6D-0F70
-             + [Cats.BottomVowel]     # 0F71
-             + [Cats.TopVowel]        # 0F72
-             + [Cats.TopVowel]        # 0F73
-             + [Cats.BottomVowel] * 2 # 0F74-0F75
-             + [Cats.TopVowel] * 8    # 0F76-0F7D
-             + [Cats.TopMark]         # 0F7E
-             + [Cats.RightMark]       # 0F7F
-             + [Cats.TopVowel] * 2    # 0F80-0F81
-             + [Cats.TopMark] * 2     # 0F82-0F83
-             + [Cats.BottomMark]      # 0F84
-             + [Cats.Other]           # 0F85
-             + [Cats.TopMark] * 2     # 0F86-0F87
-             + [Cats.Base] * 2        # 0F88-0F89
-             + [Cats.Base]            # 0F8A always followed by 0f82 (required by the Unicode spec)
-             + [Cats.Other]           # 0F8B
-             + [Cats.Base]            # 0F8C
-             + [Cats.Subscript] * 48  # 0F8D-0FBC
-             )
+# first, unify Unicode form:
+# http://www.unicode.org/faq/normalization.html
+# https://unicode.org/reports/tr15/
+# https://unicode.org/charts/normalization/chart_Tibetan.html
+# although for some reason this chart considers 0f0c -> 0f0b in NFD
+#
+# the deprecated or discouraged characters (DISCOURAGED) are decomposed
+# in both forms, these only in NFD
+NFD = {
+    "\u0f43": "\u0f42\u0fb7",
+    "\u0f4d": "\u0f4c\u0fb7",
+    "\u0f52": "\u0f51\u0fb7",
+    "\u0f57": "\u0f56\u0fb7",
+    "\u0f5c": "\u0f5b\u0fb7",
+    "\u0f69": "\u0f40\u0fb5",
+    "\u0f76": "\u0fb2\u0f80",
+    "\u0f78": "\u0fb3\u0f80",
+    "\u0f93": "\u0f92\u0fb7",
+    "\u0f9d": "\u0f9c\u0fb7",
+    "\u0fa2": "\u0fa1\u0fb7",
+    "\u0fa7": "\u0fa6\u0fb7",
+    "\u0fac": "\u0fab\u0fb7",
+    "\u0fb9": "\u0f90\u0fb5",
+    }
 
-def charcat(c):
-    ''' Returns the category for a single char string'''
-    o = ord(c)
-    if 0x0F00 <= o <= 0x0FBC:
-        return CATEGORIES[o-0x0F00]
-    return Cats.Other
+# none of the decompositions produce a character that is decomposed, so
+# they can all be done in one pass
+DECOMPOSITIONS = {
+    "nfd": str.maketrans({**DISCOURAGED, **NFD}),
+    "nfc": str.maketrans(DISCOURAGED),
+    }
 
-# debug:
-#for i, c in enumerate(CATEGORIES):
-#    print("%x : %d" % (0x0F00 + i , c.value))
+# the first characters of the pairs are all different and never appear
+# as the second character, so the matches cannot overlap
+COMPOSITIONS = {v: k for k, v in NFD.items()}
+COMPOSITIONS_RE = re.compile("|".join(COMPOSITIONS))
 
-def unicode_reorder(txt):
-    # inpired from code for Khmer Unicode provided by SIL
-    # https://docs.microsoft.com/en-us/typography/script-development/tibetan#reor
-    # https://docs.microsoft.com/en-us/typography/script-development/use#glyph-reordering
-    charcats = [charcat(c) for c in txt]
-    # find subranges of base+non other and sort components in the subrange
-    i = 0
-    res = []
-    valid = True
-    while i < len(charcats):
-        c = charcats[i]
-        if c != Cats.Base:
-            if c.value > Cats.Base.value:
-                valid = False
-            res.append(txt[i])
-            i += 1
-            continue
-        # scan for end of component
-        j = i + 1
-        while j < len(charcats) and charcats[j].value > Cats.Base.value:
-            j += 1
-        # sort syllable based on character categories
-        # sort the char indices by category then position in string
-        newindices = sorted(range(i, j), key=lambda e:(charcats[e].value, e))
-        replaces = "".join(txt[n] for n in newindices)
-        res.append(replaces)
-        i = j
-    return "".join(res), valid
+def normalize_unicode(s, form="nfd", backend="python"):
+    # one pass for the decompositions, one for the compositions in nfc,
+    # then one pass for the rules that depend on the context and the
+    # reordering, see normalize_unicode_reference()
+    normalizer = numpy_normalizer(backend, DECOMPOSITIONS[form])
+    if form == "nfd":
+        if normalizer is not None:
+            return normalizer.normalize(s)
+        s = s.translate(DECOMPOSITIONS["nfd"])
+    else:
+        s = s.translate(DECOMPOSITIONS["nfc"])
+        s = COMPOSITIONS_RE.sub(lambda m: COMPOSITIONS[m.group()], s)
+        if normalizer is not None:
+            return normalizer.to_str(normalizer.normalize_runs(normalizer.to_array(s)))
+    return RUN_RE.sub(normalize_run_match, s)
 
-def normalize_unicode(s, form="nfd"):
+def normalize_unicode_reference(s, form="nfd"):
+    # straightforward version of normalize_unicode(), kept to check it
     # first, unify Unicode form:
     # http://www.unicode.org/faq/normalization.html
     # https://unicode.org/reports/tr15/
@@ -143,5 +115,20 @@ def normalize_unicode(s, form="nfd"):
     s = re.sub(r"[\u0f71]([\u0f8d-\u0fac\u0fae\u0fb0\u0fb3-\u0fbc])", "\u0fb0\\1", s)
     # no 0fb0 at the end of stacks, only 0f71
     s = re.sub(r"[\u0fb0]([^\u0f8d-\u0fac\u0fae\u0fb0\u0fb3-\u0fbc]|$)", "\u0f71\\1", s)
-    s, valid = unicode_reorder(s)
+    s, valid = unicode_reorder_reference(s)
     return s
+
+def test():
+    s = Path(__file__).parent.joinpath("tests", "D4155.txt").read_text(encoding="utf-8")
+    for form in ["nfd", "nfc"]:
+        for t in ["\u0f42\u0fb7\u0fb7\u0f77", "\u0f40\u0fb5\u0f71\u0f7a\u0f7a\u0fb0", "\u0fb2\u0f80\u0f00\u0f76"]:
+            assert normalize_unicode(t, form) == normalize_unicode_reference(t, form)
+        assert normalize_unicode(s, form) == normalize_unicode_reference(s, form)
+        print("%s normalization OK" % form)
+        if import_numpy() is not None:
+            assert normalize_unicode(s, form, "numpy") == normalize_unicode_reference(s, form)
+            print("%s normalization with numpy OK" % form)
+    assert unicode_reorder(s) == unicode_reorder_reference(s)
+
+if __name__ == "__main__":
+    test()
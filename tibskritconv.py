@@ -1,100 +1,98 @@
 import re
+import os
+import sys
+import zlib
+import mmap
+import time
+import marshal
+from array import array
+from bisect import bisect_right
+from itertools import accumulate, islice
+from collections import OrderedDict, namedtuple, deque
+from functools import partial
+from contextlib import nullcontext
 from enum import Enum
 from pathlib import Path
 import logging
 
+from tibskrittables import (OrderCats, CATEGORIES, charcat, CATEGORY_KEYS, STACK_RE, ORPHAN_MARK_RE, sort_stack,
+                            unicode_reorder, unicode_reorder_reference, DISCOURAGED, AA_IN_STACK_RE, AA_END_STACK_RE,
+                            RUN_RE, normalize_run, RUN_CACHE_SIZE, normalize_run_match, BACKENDS, numpy_normalizer,
+                            import_numpy)
+
 ANUNASIKA_CHARACTER = "m\u0310"
 ANUNASIKA_CHARACTER_2 = "m\u0301"
 
 # first some Unicode normalization
 
-class OrderCats(Enum):
-    Other = 0
-    Base = 1
-    Subscript = 2
-    BottomVowel = 3
-    BottomMark = 4
-    TopVowel = 5
-    TopMark = 6
-    RightMark = 7
-
-CATEGORIES =  ([OrderCats.Other]           # 0F00
-             + [OrderCats.Base]            # 0F01, often followed by 0f083
-             + [OrderCats.Other] * 22      # 0F02-0F17
-             + [OrderCats.BottomVowel] * 2 # 0F18-0F19
-             + [OrderCats.Other] * 6       # 0F1A-0F1F
-             + [OrderCats.Base] * 20       # 0F20-0F33, numbers can be followed by 0f18, 0f19 or exceptionally by vowels
-             + [OrderCats.Other]           # 0F34
-             + [OrderCats.BottomMark]      # 0F35
-             + [OrderCats.Other]           # 0F36
-             + [OrderCats.BottomMark]      # OF37
-             + [OrderCats.Other]           # 0F38
-             + [OrderCats.Subscript]       # 0F39, kind of cheating but works
-             + [OrderCats.Other] * 4       # 0F3A-0F3D
-             + [OrderCats.RightMark]       # 0F3E
-             + [OrderCats.Other]           # 0F3F, not quite sure
-             + [OrderCats.Base] * 45       # 0F40-0F6C
-             + [OrderCats.Other] * 4       # 0F6D-0F70
-             + [OrderCats.BottomVowel]     # 0F71
-             + [OrderCats.TopVowel]        # 0F72
-             + [OrderCats.TopVowel]        # 0F73
-             + [OrderCats.BottomVowel] * 2 # 0F74-0F75
-             + [OrderCats.TopVowel] * 8    # 0F76-0F7D
-             + [OrderCats.TopMark]         # 0F7E
-             + [OrderCats.RightMark]       # 0F7F
-             + [OrderCats.TopVowel] * 2    # 0F80-0F81
-             + [OrderCats.TopMark] * 2     # 0F82-0F83
-             + [OrderCats.BottomMark]      # 0F84
-             + [OrderCats.Other]           # 0F85
-             + [OrderCats.TopMark] * 2     # 0F86-0F87
-             + [OrderCats.Base] * 2        # 0F88-0F89
-             + [OrderCats.Base]            # 0F8A always followed by 0f82 (required by the Unicode spec)
-             + [OrderCats.Other]           # 0F8B
-             + [OrderCats.Base]            # 0F8C
-             + [OrderCats.Subscript] * 48  # 0F8D-0FBC
-             )
-
-def charcat(c):
-    ''' Returns the category for a single char string'''
-    o = ord(c)
-    if 0x0F00 <= o <= 0x0FBC:
-        return CATEGORIES[o-0x0F00]
-    return OrderCats.Other
-
-# debug:
-#for i, c in enumerate(CATEGORIES):
-#    print("%x : %d" % (0x0F00 + i , c.value))
-
-def unicode_reorder(txt):
-    # inpired from code for Khmer Unicode provided by SIL
-    # https://docs.microsoft.com/en-us/typography/script-development/tibetan#reor
-    # https://docs.microsoft.com/en-us/typography/script-development/use#glyph-reordering
-    charcats = [charcat(c) for c in txt]
-    # find subranges of base+non other and sort components in the subrange
-    i = 0
+# The code works on both NFD and NFC so there is no need to pick one or the other
+DECOMPOSITIONS = str.maketrans(DISCOURAGED)
+
+def normalize_unicode(s, backend="python"):
+    # one pass for the decompositions, then one pass for the rules that
+    # depend on the context and the reordering, see normalize_unicode_reference()
+    if backend != "python":
+        normalizer = numpy_normalizer(backend, DECOMPOSITIONS)
+        if normalizer is not None:
+            return normalizer.normalize(s)
+    s = s.translate(DECOMPOSITIONS)
+    return RUN_RE.sub(normalize_run_match, s)
+
+DECOMPOSABLE_RE = re.compile("[%s]" % "".join(chr(c) for c in DECOMPOSITIONS))
+
+def normalize_run_with_offsets(run):
+    ''' Same as normalize_run(), also returns the index in run of each char of the result'''
+    chars = list(run)
+    indices = list(range(len(run)))
+    i = 1 if charcat(run[0]) == OrderCats.Base else 0
+    while i < len(chars) - 1:
+        if chars[i] == chars[i+1] and chars[i] in "\u0f7a\u0f7c":
+            chars[i] = "\u0f7b" if chars[i] == "\u0f7a" else "\u0f7d"
+            del chars[i+1]
+            del indices[i+1]
+        i += 1
+    # the other rules don't change the length
+    res = normalize_run(run)
+    if charcat(run[0]) == OrderCats.Base:
+        # same sort as sort_stack(), on the string before sorting
+        unsorted = run[0] + AA_END_STACK_RE.sub("\u0f71\\1", AA_IN_STACK_RE.sub("\u0fb0\\1", "".join(chars[1:])))
+        keys = unsorted.translate(CATEGORY_KEYS)
+        indices = [indices[n] for n in sorted(range(len(unsorted)), key=keys.__getitem__)]
+    return res, indices
+
+RUN_OFFSETS_CACHE = {}
+
+def normalize_unicode_with_offsets(s):
+    ''' Same as normalize_unicode(), also returns an array with the index in s of each char of the result'''
+    offsets = array("I")
+    pos = 0
+    for m in DECOMPOSABLE_RE.finditer(s):
+        offsets.extend(range(pos, m.start()))
+        offsets.extend([m.start()] * len(DECOMPOSITIONS[ord(m.group())]))
+        pos = m.end()
+    offsets.extend(range(pos, len(s)))
+    s = s.translate(DECOMPOSITIONS)
     res = []
-    valid = True
-    while i < len(charcats):
-        c = charcats[i]
-        if c != OrderCats.Base:
-            if c.value > OrderCats.Base.value:
-                valid = False
-            res.append(txt[i])
-            i += 1
-            continue
-        # scan for end of component
-        j = i + 1
-        while j < len(charcats) and charcats[j].value > OrderCats.Base.value:
-            j += 1
-        # sort syllable based on character categories
-        # sort the char indices by category then position in string
-        newindices = sorted(range(i, j), key=lambda e:(charcats[e].value, e))
-        replaces = "".join(txt[n] for n in newindices)
-        res.append(replaces)
-        i = j
-    return "".join(res), valid
-
-def normalize_unicode(s):
+    res_offsets = array("I")
+    pos = 0
+    for m in RUN_RE.finditer(s):
+        res.append(s[pos:m.start()])
+        res_offsets.extend(offsets[pos:m.start()])
+        run = m.group()
+        r = RUN_OFFSETS_CACHE.get(run)
+        if r is None:
+            r = normalize_run_with_offsets(run)
+            if len(RUN_OFFSETS_CACHE) < RUN_CACHE_SIZE:
+                RUN_OFFSETS_CACHE[run] = r
+        res.append(r[0])
+        res_offsets.extend(offsets[m.start() + i] for i in r[1])
+        pos = m.end()
+    res.append(s[pos:])
+    res_offsets.extend(offsets[pos:])
+    return "".join(res), res_offsets
+
+def normalize_unicode_reference(s):
+    # straightforward version of normalize_unicode(), kept to check it
     # The code works on both NFD and NFC so there is no need to pick one or the other
     # deprecated or discouraged characters
     s = s.replace("\u0f73", "\u0f71\u0f72") # use is discouraged
@@ -115,7 +113,7 @@ def normalize_unicode(s):
     s = re.sub(r"[\u0f71]([\u0f8d-\u0fac\u0fae\u0fb0\u0fb3-\u0fbc])", "\u0fb0\\1", s)
     # no 0fb0 at the end of stacks, only 0f71
     s = re.sub(r"[\u0fb0]([^\u0f8d-\u0fac\u0fae\u0fb0\u0fb3-\u0fbc]|$)", "\u0f71\\1", s)
-    s, valid = unicode_reorder(s)
+    s, valid = unicode_reorder_reference(s)
     return s
 
 
@@ -152,10 +150,29 @@ class State(Enum):
     AfterVirama = 3
 
 class StateAutomaton():
-    def __init__(self):
-        self.res = ""
+    def __init__(self, write=None):
+        # the output is written with write(s, offset), offset being the
+        # offset of the token s comes from; by default in a list joined by
+        # get_result()
+        self.out = []
+        self.write = write if write is not None else self.write_out
+        # offset of the current token, set by the caller
+        self.offset = 0
+        # offsets of the tokens of the current aksara
+        self.r_offset = 0
+        self.l_offset = 0
+        self.vowel_offset = 0
+        self.post_vowel_offset = 0
+        # (message, offset) of the problems found
+        self.diagnostics = []
         self.reset()
 
+    def write_out(self, s, offset):
+        self.out.append(s)
+
+    def warn(self, message):
+        self.diagnostics.append((message, self.offset))
+
     def reset(self):
         self.in_aksara = False
         self.lengthened = False
@@ -172,44 +189,46 @@ class StateAutomaton():
             if self.lengthened:
                 self.vowel = lengthen(self.vowel)
             if self.after_r:
-                self.res += "r"+self.vowel
+                self.write("r", self.r_offset)
             elif self.after_l:
-                self.res += "l"+self.vowel
-            else:
-                self.res += self.vowel
+                self.write("l", self.l_offset)
+            self.write(self.vowel, self.vowel_offset)
             if self.post_vowel:
-                self.res += self.post_vowel
+                self.write(self.post_vowel, self.post_vowel_offset)
                 self.post_vowel = None
         self.reset()
 
     def get_result(self):
+        ''' Finishes the conversion, returns the output if no writer was given'''
         self.finish_aksara()
-        return self.res
+        return "".join(self.out)
         
     def update_with_token(self, t):
         (token_s, cat, special) = t
-        logging.debug("new token (%s, %s, %s), state ('%s', %s, r=%s, l=%s, long=%s)", token_s, cat, special, self.res, self.state, self.after_r, self.after_l, self.lengthened)
         if cat == Cats.Base and (special == Special.L or special == Special.R):
             if self.state == State.AfterConsonant or State.AfterVowel:
                 # add a
                 self.finish_aksara()
         if special == Special.R:
             if self.after_l:
-                self.res += "l"
+                self.write("l", self.l_offset)
                 self.after_l = False
             if self.after_r:
-                self.res += "r"
+                self.write("r", self.r_offset)
             self.after_r = True
+            self.r_offset = self.vowel_offset = self.offset
             self.state = State.AfterConsonant
         elif special == Special.L:
             if self.after_r:
-                self.res += "r"
+                self.write("r", self.r_offset)
                 self.after_r = False
             if self.after_l:
-                self.res += "l"
+                self.write("l", self.l_offset)
             self.after_l = True
+            self.l_offset = self.vowel_offset = self.offset
             self.state = State.AfterConsonant
         elif special == Special.I or special == Special.LongI:
+            self.vowel_offset = self.offset
             if special == Special.LongI:
                 self.lengthened = True
             if self.after_r:
@@ -223,11 +242,11 @@ class StateAutomaton():
                 else:
                     self.vowel = "ḷ"
             else:
-                logging.warning("reverse gigu should only be after l or r")
+                self.warn("reverse gigu should only be after l or r")
                 self.vowel = token_s
                 if self.lengthened:
                     self.vowel = lengthen(self.vowel)
-                self.res += self.vowel
+                self.write(self.vowel, self.offset)
             self.state = State.AfterVowel
             self.after_l = False
             self.after_r = False
@@ -238,8 +257,10 @@ class StateAutomaton():
                 self.vowel = lengthen(self.vowel)
             else:
                 self.lengthened = True
+                self.vowel_offset = self.offset
         else:
             if cat == Cats.Vowel:
+                self.vowel_offset = self.offset
                 if self.lengthened:
                     self.vowel = lengthen(token_s)
                     self.lengthened = False
@@ -248,30 +269,42 @@ class StateAutomaton():
                 self.state = State.AfterVowel
             else:
                 if self.after_r:
-                    self.res += "r"
+                    self.write("r", self.r_offset)
                     self.after_r = False
                 if self.after_l:
-                    self.res += "l"
+                    self.write("l", self.l_offset)
                     self.after_l = False
             if cat == Cats.Other:
                 self.finish_aksara()
-                self.res += token_s
+                self.write(token_s, self.offset)
                 self.state = State.Other
             if cat == Cats.Virama:
                 if self.state == State.AfterVowel:
-                    logging.warn("virama after a vowel")
+                    self.warn("virama after a vowel")
                 self.reset()
                 self.state = State.AfterVirama
             if cat == Cats.AfterVowel:
                 self.post_vowel = token_s
+                self.post_vowel_offset = self.offset
             if cat == Cats.Base:
                 if self.state == State.AfterConsonant or self.state == State.AfterVowel:
                     # add a
                     self.finish_aksara()
-                self.res += token_s
+                self.write(token_s, self.offset)
+                self.vowel_offset = self.offset
                 self.state = State.AfterConsonant
             if cat == Cats.Subscript:
-                self.res += token_s
+                self.write(token_s, self.offset)
+                self.vowel_offset = self.offset
+
+class TracingStateAutomaton(StateAutomaton):
+    ''' Automaton logging each token and its state, see tibskrit_to_iast(trace=True)'''
+    def update_with_token(self, t):
+        (token_s, cat, special) = t
+        # the output so far is only joined if it is logged
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug("new token (%s, %s, %s), state ('%s', %s, r=%s, l=%s, long=%s)", token_s, cat, special, "".join(self.out), self.state, self.after_r, self.after_l, self.lengthened)
+        super().update_with_token(t)
 
 TSEG = " "
 
@@ -388,9 +421,609 @@ CHAR_TOKENS = {
 
 NON_SANSKRIT_CHARS = ["ཞ", "ཟ", "འ", "\u0fb8", "\u0fae", "\u0faf", "\u0fb0"]
 
-def tibskrit_to_iast(s):
+# Output schemes: the automaton writes IAST units (the strings of CHAR_TOKENS,
+# "r" and "l", and the vowels, lengthened or vocalic), each scheme gives the
+# units it writes differently. Punctuation is kept as in IAST.
+SCHEMES = {
+    "iast": {},
+    "iso15919": {
+        "ṛ": "r\u0325", "ṝ": "r\u0325\u0304", "ḷ": "l\u0325", "ḹ": "l\u0325\u0304",
+        "e": "ē", "o": "ō", "ṃ": "ṁ", "oṃ": "ōṁ",
+        },
+    "hk": {
+        "ā": "A", "ī": "I", "ū": "U", "ṛ": "R", "ṝ": "RR", "ḷ": "lR", "ḹ": "lRR",
+        "ṃ": "M", "ḥ": "H", ANUNASIKA_CHARACTER: "~", ANUNASIKA_CHARACTER_2: "~", "’": "'",
+        "ṅ": "G", "ñ": "J", "ṭ": "T", "ṭh": "Th", "ḍ": "D", "ḍh": "Dh", "ṇ": "N",
+        "ś": "z", "ṣ": "S", "kṣ": "kS", "oṃ": "oM",
+        },
+    "slp1": {
+        "ā": "A", "ī": "I", "ū": "U", "ṛ": "f", "ṝ": "F", "ḷ": "x", "ḹ": "X", "ai": "E", "au": "O",
+        "ṃ": "M", "ḥ": "H", ANUNASIKA_CHARACTER: "~", ANUNASIKA_CHARACTER_2: "~", "’": "'",
+        "kh": "K", "gh": "G", "ṅ": "N", "ch": "C", "jh": "J", "ñ": "Y", "ṭ": "w", "ṭh": "W",
+        "ḍ": "q", "ḍh": "Q", "ṇ": "R", "th": "T", "dh": "D", "ph": "P", "bh": "B",
+        "ś": "S", "ṣ": "z", "kṣ": "kz", "oṃ": "oM",
+        },
+    }
+
+# The aspirates written as a stop and a subscript h are two units. The
+# subscript h is written as a unit of its own (its char) in the schemes,
+# joined with the stop before it in the schemes that have one letter for
+# the aspirate (stop -> aspirate), "h" in the others. A stop followed by
+# the h of another aksara (ཀ྄ཧ) is not joined.
+SUBSCRIPT_H = "\u0fb7"
+SCHEME_CLUSTERS = {
+    "slp1": {"k": "K", "g": "G", "c": "C", "j": "J", "w": "W", "q": "Q", "t": "T", "d": "D", "p": "P", "b": "B"},
+    }
+SCHEME_CLUSTERS_RE = {scheme: re.compile("([%s]?)%s" % ("".join(clusters), SUBSCRIPT_H)) for scheme, clusters in SCHEME_CLUSTERS.items()}
+
+def join_clusters(s, scheme):
+    ''' Writes the subscript h units of s, in scheme'''
+    if SUBSCRIPT_H not in s:
+        return s
+    clusters = SCHEME_CLUSTERS.get(scheme)
+    if clusters is None:
+        return s.replace(SUBSCRIPT_H, "h")
+    return SCHEME_CLUSTERS_RE[scheme].sub(lambda m: clusters[m.group(1)] if m.group(1) else "h", s)
+
+def convert_chars(state, s):
+    ''' Feeds the characters of normalized string s to the automaton'''
+    for i, c in enumerate(s):
+        state.offset = i
+        if c in CHAR_TOKENS:
+            state.update_with_token(CHAR_TOKENS[c])
+        else:
+            if c in NON_SANSKRIT_CHARS:
+                state.warn("%s cannot be converted to IAST" % c)
+                continue
+            if c != "\n":
+                c = ""
+            state.update_with_token((c, Cats.Other, 0))
+
+# The automaton compiled into a table: its state (without the offsets) only
+# takes a few hundred values, so all the transitions are computed once by
+# running the automaton on each (state, token) pair. Characters are grouped
+# in classes, one per distinct token; class 0 is the empty Other token of
+# the characters that are not in CHAR_TOKENS.
+
+def automaton_key(state):
+    return (state.state, state.lengthened, state.after_r, state.after_l, state.vowel, state.post_vowel)
+
+def set_automaton_key(state, key):
+    (state.state, state.lengthened, state.after_r, state.after_l, state.vowel, state.post_vowel) = key
+
+def code_checksum(code, h=0):
+    ''' Returns the crc32 of the bytecode and constants of code, and of the functions
+    defined in it (whose repr contains their address)'''
+    h = zlib.crc32(code.co_code, h)
+    for c in code.co_consts:
+        if isinstance(c, type(code)):
+            h = code_checksum(c, h)
+        else:
+            h = zlib.crc32(repr(c).encode("utf-8"), h)
+    return h
+
+def dfa_version():
+    ''' Returns a checksum of the rules, the cached table is rebuilt when it changes'''
+    h = zlib.crc32(repr((sorted(CHAR_TOKENS.items()), NON_SANSKRIT_CHARS)).encode("utf-8"))
+    for f in [StateAutomaton.reset, StateAutomaton.finish_aksara, StateAutomaton.update_with_token, lengthen,
+              TransliterationDFA.build]:
+        h = code_checksum(f.__code__, h)
+    return h
+
+class TransliterationDFA():
+    ''' Transition table equivalent to StateAutomaton, see build(). States are
+    integers premultiplied by the number of classes, so that the index of a
+    transition is state + class.'''
+    def __init__(self, classes, nb_classes, next_states, emits, warnings, finals, units, version=None):
+        # char -> class, the other chars are in class 0
+        self.classes = classes
+        self.nb_classes = nb_classes
+        # for each transition: the next state, the output and a warning (or None)
+        self.next_states = next_states
+        self.emits = emits
+        self.warnings = warnings
+        # for each state: the output of get_result()
+        self.finals = finals
+        # the IAST units of the outputs of the transitions and of the states, written
+        # in other schemes by scheme_table(). Only IAST is needed most of the time,
+        # so they are kept marshalled until then.
+        self.units = units
+        self.version = version
+        self.scheme_tables = {"iast": (emits, finals, SCHEMES["iast"])}
+
+    @classmethod
+    def build(cls):
+        tokens = [("", Cats.Other, 0), ("\n", Cats.Other, 0)]
+        classes = {"\n": 1}
+        for c, t in CHAR_TOKENS.items():
+            # the keys of more than one char are never looked up by convert_chars()
+            if len(c) == 1:
+                if t not in tokens:
+                    tokens.append(t)
+                classes[c] = tokens.index(t)
+        # non-Sanskrit chars only add a warning
+        messages = []
+        for c in NON_SANSKRIT_CHARS:
+            classes[c] = len(tokens) + len(messages)
+            messages.append("%s cannot be converted to IAST" % c)
+        nb_classes = len(tokens) + len(messages)
+        automaton = StateAutomaton()
+        keys = [automaton_key(automaton)]
+        indexes = {keys[0]: 0}
+        next_states, emits, warnings, finals, emit_units, final_units = [], [], [], [], [], []
+        # the same outputs are shared, so that they are only serialized once
+        shared = {}
+        i = 0
+        while i < len(keys):
+            for t in tokens:
+                automaton.out, automaton.diagnostics = [], []
+                set_automaton_key(automaton, keys[i])
+                automaton.update_with_token(t)
+                key = automaton_key(automaton)
+                if key not in indexes:
+                    indexes[key] = len(keys)
+                    keys.append(key)
+                assert len(automaton.diagnostics) <= 1
+                next_states.append(indexes[key] * nb_classes)
+                emit = "".join(automaton.out)
+                emits.append(shared.setdefault(emit, emit))
+                units = tuple(automaton.out)
+                if t == CHAR_TOKENS[SUBSCRIPT_H]:
+                    # its "h" is written last, see join_clusters()
+                    units = units[:-1] + (SUBSCRIPT_H,)
+                emit_units.append(shared.setdefault(units, units))
+                warnings.append(automaton.diagnostics[0][0] if automaton.diagnostics else None)
+            for message in messages:
+                next_states.append(i * nb_classes)
+                emits.append("")
+                emit_units.append(())
+                warnings.append(message)
+            automaton.out = []
+            set_automaton_key(automaton, keys[i])
+            finals.append(automaton.get_result())
+            final_units.append(tuple(automaton.out))
+            i += 1
+        return cls(classes, nb_classes, next_states, emits, warnings, finals, marshal.dumps((emit_units, final_units)), dfa_version())
+
+    def to_bytes(self):
+        return marshal.dumps((self.classes, self.nb_classes, self.next_states, self.emits, self.warnings, self.finals,
+                              self.units, self.version))
+
+    @classmethod
+    def from_bytes(cls, b):
+        return cls(*marshal.loads(b))
+
+    def run(self, s, reset=False):
+        ''' Returns the output of the automaton fed with s, followed by an empty
+        Other token if reset is true, and its diagnostics (message, offset)'''
+        classes = self.classes
+        next_states = self.next_states
+        emits = self.emits
+        warnings = self.warnings
+        state = 0
+        out = []
+        diagnostics = []
+        for i, c in enumerate(s):
+            k = state + classes.get(c, 0)
+            out.append(emits[k])
+            if warnings[k] is not None:
+                diagnostics.append((warnings[k], i))
+            state = next_states[k]
+        if reset:
+            out.append(emits[state])
+            state = next_states[state]
+        out.append(self.finals[state // self.nb_classes])
+        return "".join(out), diagnostics
+
+    def scheme_table(self, scheme):
+        ''' Returns the outputs of the transitions and of the states in scheme, and
+        the units of the scheme'''
+        table = self.scheme_tables.get(scheme)
+        if table is None:
+            units = SCHEMES[scheme]
+            emit_units, final_units = marshal.loads(self.units)
+            shared = {}
+            def write(t):
+                s = "".join(units.get(u, u) for u in t)
+                return shared.setdefault(s, s)
+            table = ([write(t) for t in emit_units], [write(t) for t in final_units], units)
+            self.scheme_tables[scheme] = table
+        return table
+
+    def run_schemes(self, s, reset=False, schemes=("iast",)):
+        ''' Same as run(), returns the output in each of schemes (a tuple)'''
+        classes = self.classes
+        next_states = self.next_states
+        warnings = self.warnings
+        state = 0
+        transitions = []
+        diagnostics = []
+        for i, c in enumerate(s):
+            k = state + classes.get(c, 0)
+            transitions.append(k)
+            if warnings[k] is not None:
+                diagnostics.append((warnings[k], i))
+            state = next_states[k]
+        if reset:
+            transitions.append(state)
+            state = next_states[state]
+        final = state // self.nb_classes
+        res = []
+        for scheme in schemes:
+            emits, finals, _ = self.scheme_table(scheme)
+            res.append(join_clusters("".join(map(emits.__getitem__, transitions)) + finals[final], scheme))
+        return tuple(res), diagnostics
+
+# the table is cached in __pycache__, next to the compiled module
+DFA_CACHE_FILE = Path(__file__).parent.joinpath("__pycache__", "tibskritconv.dfa")
+
+DFA = None
+
+def write_atomic(path, b):
+    ''' Writes b to path through a temporary file in the same directory, so that
+    other processes read either the old or the new content'''
+    path = Path(path)
+    tmp = path.with_name("%s.%d.%s.tmp" % (path.name, os.getpid(), os.urandom(4).hex()))
+    # not mkstemp(), its files are private (0600): the cache must be readable
+    # by the other users of the installation
+    fd = os.open(tmp, os.O_WRONLY | os.O_CREAT | os.O_EXCL | getattr(os, "O_BINARY", 0), 0o644)
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(b)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+def get_dfa():
+    ''' Returns the TransliterationDFA, read from DFA_CACHE_FILE if it is up to date,
+    else built and saved there'''
+    global DFA
+    if DFA is not None:
+        return DFA
+    version = dfa_version()
+    try:
+        dfa = TransliterationDFA.from_bytes(DFA_CACHE_FILE.read_bytes())
+        if dfa.version == version:
+            DFA = dfa
+            return DFA
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+    DFA = TransliterationDFA.build()
+    try:
+        DFA_CACHE_FILE.parent.mkdir(exist_ok=True)
+        # pool workers can build the table at the same time
+        write_atomic(DFA_CACHE_FILE, DFA.to_bytes())
+    except OSError:
+        # read-only installation, the table is built at each run
+        pass
+    return DFA
+
+class ConversionReport():
+    ''' Problems found during a conversion: the offsets of each message, in the normalized text'''
+    def __init__(self):
+        self.offsets = {}
+
+    def __bool__(self):
+        return bool(self.offsets)
+
+    def add(self, diagnostics, base=0):
+        for message, offset in diagnostics:
+            self.offsets.setdefault(message, []).append(base + offset)
+
+    def counts(self):
+        return {message: len(offsets) for message, offsets in self.offsets.items()}
+
+    def summary(self):
+        return "; ".join("%s (%d times, first at %d)" % (message, len(offsets), offsets[0])
+                         for message, offsets in self.offsets.items())
+
+# The decomposition and the rules applied to the stacks with their reordering
+# (in one pass) are timed separately from the conversion by the automaton
+PHASES = ["decompose", "reorder", "convert"]
+
+class ConversionStats():
+    ''' Counters and time spent in each phase (in seconds) of one or more conversions,
+    see tibskrit_to_iast(stats=...) and set_metrics_callback()'''
+    COUNTERS = ["calls", "chars", "normalized_chars", "stacks_reordered", "orphan_marks",
+                "non_sanskrit", "cache_hits", "cache_misses"]
+
+    def __init__(self):
+        self.calls = 0
+        self.chars = 0
+        self.normalized_chars = 0
+        # stacks that were not in the canonical order
+        self.stacks_reordered = 0
+        # marks that are not after a base (valid=False for unicode_reorder())
+        self.orphan_marks = 0
+        # dropped chars of NON_SANSKRIT_CHARS
+        self.non_sanskrit = 0
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.seconds = dict.fromkeys(PHASES, 0.0)
+
+    def add(self, other):
+        for name in self.COUNTERS:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+        for phase in PHASES:
+            self.seconds[phase] += other.seconds[phase]
+
+    def as_dict(self):
+        res = {name: getattr(self, name) for name in self.COUNTERS}
+        res["seconds"] = dict(self.seconds)
+        return res
+
+    def summary(self):
+        return "%d chars in %.1f ms (%s), %d stacks reordered, %d orphan marks, %d non-Sanskrit chars, cache %d/%d" % (
+            self.chars, sum(self.seconds.values()) * 1000, ", ".join("%s %.1f" % (p, self.seconds[p] * 1000) for p in PHASES),
+            self.stacks_reordered, self.orphan_marks, self.non_sanskrit, self.cache_hits, self.cache_hits + self.cache_misses)
+
+# The characters that are not in a syllable are converted into an Other
+# token that puts the automaton back in its initial state, so syllables
+# can be converted independently.
+SYLLABLE_CHARS = "".join(c for c, t in CHAR_TOKENS.items() if len(c) == 1 and t[1] != Cats.Other) + "".join(NON_SANSKRIT_CHARS)
+# Text outside of the Tibetan block (folio markers, markup, Latin) is
+# matched in bulk: runs of non-Tibetan characters, possibly with spaces
+# inside and around, but no newline. Spaces between Tibetan characters are
+# not part of a span and are always dropped.
+NON_TIBETAN_SPAN = r"[^\S\n]*[^\u0f00-\u0fff\s]+(?:[^\S\n]+[^\u0f00-\u0fff\s]+)*[^\S\n]*"
+# a syllable followed by a span of non-Tibetan text or by another reset char,
+# spaces are matched as one separator (else each would try the span again)
+SYLLABLE_RE = re.compile("([%s]*)(?:(%s)|([^\\S\\n]+|.?))" % (SYLLABLE_CHARS, NON_TIBETAN_SPAN), re.S)
+
+# what to do with the non-Tibetan text: drop it (except newlines), keep
+# it as is or keep it surrounded by MARK_FORMAT
+NON_TIBETAN_POLICIES = ["drop", "keep", "mark"]
+MARK_FORMAT = "<%s>"
+
+# the IAST of the chars between syllables, the others are dropped
+SEPARATORS = {c: t[0] for c, t in CHAR_TOKENS.items() if len(c) == 1 and t[1] == Cats.Other}
+SEPARATORS["\n"] = "\n"
+
+def mark_span(span, mark_format=MARK_FORMAT):
+    ''' Returns a span of non-Tibetan text with mark_format, the spaces around it stay outside'''
+    start = len(span) - len(span.lstrip())
+    end = len(span.rstrip())
+    return span[:start] + mark_format % span[start:end] + span[end:]
+
+SYLLABLE_CACHE_SIZE = 16384
+# longer syllables are usually whole lines without tsheg, not worth caching
+SYLLABLE_CACHE_MAX_LEN = 32
+
+CacheInfo = namedtuple("CacheInfo", ["hits", "misses", "maxsize", "currsize"])
+
+class SyllableConverter():
+    ''' Converts normalized text syllable by syllable, with a LRU cache of
+    the IAST of syllables. The syllables that are not in the cache are
+    converted with the TransliterationDFA, or with automaton_class if given.
+
+    With schemes (names of SCHEMES), the syllables are converted in all of
+    them at once and convert() returns a tuple.'''
+    def __init__(self, maxsize=SYLLABLE_CACHE_SIZE, automaton_class=None, schemes=None):
+        self.maxsize = maxsize
+        self.automaton_class = automaton_class
+        self.schemes = schemes
+        # output of the reset chars that are not in syllables
+        self.separators = SEPARATORS
+        if schemes is not None:
+            self.separators = {sep: tuple(SCHEMES[scheme].get(u, u) for scheme in schemes) for sep, u in SEPARATORS.items()}
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def cache_info(self):
+        return CacheInfo(self.hits, self.misses, self.maxsize, len(self.cache))
+
+    def cache_clear(self):
+        self.cache.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def run(self, s, reset=False):
+        if self.schemes is not None:
+            res, diagnostics = get_dfa().run_schemes(s, reset, self.schemes)
+            return res, tuple(diagnostics)
+        if self.automaton_class is None:
+            iast, diagnostics = get_dfa().run(s, reset)
+            return iast, tuple(diagnostics)
+        state = self.automaton_class()
+        convert_chars(state, s)
+        if reset:
+            state.update_with_token(("", Cats.Other, 0))
+        return state.get_result(), tuple(state.diagnostics)
+
+    def convert_syllable(self, syl):
+        ''' Returns the IAST of a syllable followed by a reset char and
+        its diagnostics, with offsets in the syllable'''
+        res = self.cache.get(syl)
+        if res is not None:
+            self.hits += 1
+            self.cache.move_to_end(syl)
+            return res
+        self.misses += 1
+        res = self.run(syl, True)
+        if len(syl) <= SYLLABLE_CACHE_MAX_LEN and self.maxsize > 0:
+            self.cache[syl] = res
+            if len(self.cache) > self.maxsize:
+                self.cache.popitem(last=False)
+        return res
+
+    def convert(self, s, report=None, non_tibetan="drop", mark_format=MARK_FORMAT, base=0, matches=None):
+        ''' Converts a normalized string, adding the problems found to report if given,
+        at their offset plus base. non_tibetan is one of NON_TIBETAN_POLICIES.
+        matches are the groups of SYLLABLE_RE in s, if they are already known.
+
+        With schemes, returns a tuple with the result in each scheme: the syllables
+        and separators are then tuples, the non-Tibetan text is the same in all.'''
+        separators = self.separators
+        if self.schemes is None:
+            text = str
+        else:
+            nb_schemes = len(self.schemes)
+            def text(span):
+                return (span,) * nb_schemes
+        res = []
+        pos = base
+        if matches is None:
+            matches = SYLLABLE_RE.findall(s)
+        for syl, span, sep in matches:
+            if span or sep:
+                if syl:
+                    iast, diagnostics = self.convert_syllable(syl)
+                    res.append(iast)
+                    if diagnostics and report is not None:
+                        report.add(diagnostics, pos)
+                if span:
+                    if non_tibetan == "keep":
+                        res.append(text(span))
+                    elif non_tibetan == "mark":
+                        res.append(text(mark_span(span, mark_format)))
+                    pos += len(syl) + len(span)
+                    continue
+                t = separators.get(sep)
+                if t is not None:
+                    res.append(t)
+            elif syl:
+                # end of the text, the automaton is not reset by a last token
+                iast, diagnostics = self.run(syl)
+                res.append(iast)
+                if diagnostics and report is not None:
+                    report.add(diagnostics, pos)
+            pos += len(syl) + len(sep)
+        if self.schemes is None:
+            return "".join(res)
+        if not res:
+            return ("",) * nb_schemes
+        return tuple(map("".join, zip(*res)))
+
+CONVERTER = SyllableConverter()
+
+# converters of tibskrit_to_schemes(), by tuple of schemes
+SCHEME_CONVERTERS = {}
+
+METRICS_CALLBACK = None
+
+def set_metrics_callback(callback):
+    ''' Calls callback with the ConversionStats of each conversion by tibskrit_to_iast(),
+    None to stop. Returns the previous callback.'''
+    global METRICS_CALLBACK
+    previous = METRICS_CALLBACK
+    METRICS_CALLBACK = callback
+    return previous
+
+def convert_with_stats(converter, s, report, non_tibetan, mark_format, backend, stats):
+    ''' Same as the conversion in tibskrit_to_iast(), measuring each phase'''
+    res = ConversionStats()
+    hits, misses = converter.hits, converter.misses
+    normalizer = numpy_normalizer(backend, DECOMPOSITIONS)
+    start = time.perf_counter()
+    if normalizer is not None:
+        a = normalizer.decompose(normalizer.to_array(s))
+        decomposed = time.perf_counter()
+        normalized = normalizer.to_str(normalizer.normalize_runs(a))
+    else:
+        a = s.translate(DECOMPOSITIONS)
+        decomposed = time.perf_counter()
+        normalized = RUN_RE.sub(normalize_run_match, a)
+    reordered = time.perf_counter()
+    iast = converter.convert(normalized, report, non_tibetan, mark_format)
+    res.seconds = {"decompose": decomposed - start, "reorder": reordered - decomposed, "convert": time.perf_counter() - reordered}
+    # the counts are not part of the timings
+    if normalizer is not None:
+        a = normalizer.to_str(a)
+    res.calls = 1
+    res.chars = len(s)
+    res.normalized_chars = len(normalized)
+    res.stacks_reordered = sum(1 for m in STACK_RE.finditer(a) if sort_stack(m.group()) != m.group())
+    res.orphan_marks = len(ORPHAN_MARK_RE.findall(normalized))
+    res.non_sanskrit = sum(normalized.count(c) for c in NON_SANSKRIT_CHARS)
+    res.cache_hits = converter.hits - hits
+    res.cache_misses = converter.misses - misses
+    if stats is not None:
+        stats.add(res)
+    if METRICS_CALLBACK is not None:
+        METRICS_CALLBACK(res)
+    return iast
+
+def tibskrit_to_iast(s, report=None, trace=False, non_tibetan="drop", mark_format=MARK_FORMAT, backend="python", stats=None):
+    ''' Converts s to IAST. The problems found are added to report (a ConversionReport)
+    if it is given, else they are summarized in one log message. With trace=True,
+    every token and state of the automaton is logged (debug level).
+
+    Non-Tibetan text (folio markers, Latin, etc.) is dropped by default, except
+    newlines. With non_tibetan="keep" it is kept as is, with non_tibetan="mark"
+    it is kept with mark_format (for instance "[1b.1]" -> "<[1b.1]>").
+
+    backend="numpy" normalizes with numpy if it is installed, which is faster
+    on big texts (see BACKENDS).
+
+    If stats (a ConversionStats) is given, the timings and counters of the
+    conversion are added to it, see also set_metrics_callback().'''
+    if non_tibetan not in NON_TIBETAN_POLICIES:
+        raise ValueError("non_tibetan must be one of %s" % ", ".join(NON_TIBETAN_POLICIES))
+    converter = CONVERTER
+    if trace:
+        converter = SyllableConverter(maxsize=0, automaton_class=TracingStateAutomaton)
+    log = report is None
+    if log:
+        report = ConversionReport()
+    if stats is None and METRICS_CALLBACK is None:
+        res = converter.convert(normalize_unicode(s, backend), report, non_tibetan, mark_format)
+    else:
+        res = convert_with_stats(converter, s, report, non_tibetan, mark_format, backend, stats)
+    if log and report:
+        logging.warning("conversion to IAST: %s", report.summary())
+    return res
+
+def tibskrit_to_schemes(s, schemes=tuple(SCHEMES), report=None, non_tibetan="drop", mark_format=MARK_FORMAT, backend="python"):
+    ''' Converts s in several schemes of SCHEMES (IAST, ISO 15919, Harvard-Kyoto, SLP1) at
+    once, returns {scheme: result}. The text is normalized and tokenized once, the other
+    arguments are the ones of tibskrit_to_iast().'''
+    if non_tibetan not in NON_TIBETAN_POLICIES:
+        raise ValueError("non_tibetan must be one of %s" % ", ".join(NON_TIBETAN_POLICIES))
+    schemes = tuple(schemes)
+    for scheme in schemes:
+        if scheme not in SCHEMES:
+            raise ValueError("unknown scheme %s, must be one of %s" % (scheme, ", ".join(SCHEMES)))
+    converter = SCHEME_CONVERTERS.get(schemes)
+    if converter is None:
+        converter = SCHEME_CONVERTERS[schemes] = SyllableConverter(schemes=schemes)
+    log = report is None
+    if log:
+        report = ConversionReport()
+    res = converter.convert(normalize_unicode(s, backend), report, non_tibetan, mark_format)
+    if log and report:
+        logging.warning("conversion to IAST: %s", report.summary())
+    return dict(zip(schemes, res))
+
+def tibskrit_to_iast_with_stats(s, **kwargs):
+    ''' Converts s to IAST, also returns the ConversionStats of the conversion.
+    The other arguments are the ones of tibskrit_to_iast().'''
+    stats = ConversionStats()
+    return tibskrit_to_iast(s, stats=stats, **kwargs), stats
+
+def tibskrit_to_iast_with_offsets(s):
+    ''' Converts s to IAST, also returns an array with, for each char of the result,
+    the index in s of the character it comes from (taking reordering into account)'''
+    s, norm_offsets = normalize_unicode_with_offsets(s)
+    out = []
+    offsets = array("I")
+    def write(token_s, offset):
+        out.append(token_s)
+        offsets.extend([norm_offsets[offset]] * len(token_s))
+    state = StateAutomaton(write)
+    convert_chars(state, s)
+    state.get_result()
+    if state.diagnostics:
+        report = ConversionReport()
+        report.add(state.diagnostics)
+        logging.warning("conversion to IAST: %s", report.summary())
+    return "".join(out), offsets
+
+def tibskrit_to_iast_reference(s):
+    # straightforward version of tibskrit_to_iast(), kept to check it
     state = StateAutomaton()
-    s = normalize_unicode(s)
+    s = normalize_unicode_reference(s)
     for c in s:
         if c in CHAR_TOKENS:
             state.update_with_token(CHAR_TOKENS[c])
@@ -403,6 +1036,623 @@ def tibskrit_to_iast(s):
             state.update_with_token((c, Cats.Other, 0))
     return state.get_result()
 
+# IAST to Tibetan, for instance to search a Tibetan text with IAST: the
+# inverse of CHAR_TOKENS. The IAST is cut into the longest units found in
+# a trie, consonants are stacked until a vowel, the first as a base and
+# the others as subscripts.
+
+# vocalic r and l are written with a reverse gigu: subscript (or base if
+# there is no consonant before) r or l, lengthener if long, and 0f80
+VIRAMA = "\u0f84"
+
+VOCALIC_RL = {"ṛ": (Special.R, False), "ṝ": (Special.R, True), "ḷ": (Special.L, False), "ḹ": (Special.L, True)}
+
+# Tibetan chars written for the IAST units that several chars convert to:
+# ཧ and not གྷ (which CHAR_TOKENS converts to "h"), the Sanskrit ཙ, ཚ, ཛ,
+# and the usual forms of the subscripts, ra and shad
+REVERSE_CHARS = {
+    Cats.Base: {"h": "ཧ", "c": "ཙ", "ch": "ཚ", "j": "ཛ", "r": "ར"},
+    Cats.Subscript: {"c": "\u0fa9", "ch": "\u0faa", "j": "\u0fab", "v": "\u0fad", "y": "\u0fb1", "r": "\u0fb2"},
+    Cats.Other: {"|": "།"},
+    }
+
+class ReverseConverter():
+    ''' Converts IAST to Tibetan, see iast_to_tibskrit()'''
+    def __init__(self):
+        import unicodedata
+        self.bases = {}
+        self.subscripts = {}
+        self.vowels = {}
+        self.marks = {}
+        self.others = {}
+        tables = {Cats.Base: self.bases, Cats.Subscript: self.subscripts, Cats.Vowel: self.vowels,
+                  Cats.AfterVowel: self.marks, Cats.Other: self.others}
+        candidates = {}
+        for c, (token_s, cat, special) in CHAR_TOKENS.items():
+            if token_s and special in [0, Special.R, Special.L, Special.Lengthener] and cat in tables:
+                candidates.setdefault((cat, token_s), []).append(c)
+        for (cat, unit), chars in candidates.items():
+            c = REVERSE_CHARS.get(cat, {}).get(unit)
+            if c is None:
+                if len(chars) > 1:
+                    raise ValueError("%s converts to %s, add the one to write to REVERSE_CHARS" % (" and ".join(chars), unit))
+                c = chars[0]
+            # decomposed, as in most texts: བ + ྷ and not བྷ
+            tables[cat][unit] = unicodedata.normalize("NFD", c)
+        # ༀ is decomposed by the normalization, and "oṃ" is also o + ṃ
+        del self.others["oṃ"]
+        for unit, c in self.subscripts.items():
+            if unit not in self.bases:
+                # aspirates with no base char: base and subscript h
+                self.bases[unit] = self.bases[unit[0]] + self.subscripts[unit[1:]]
+        # base of the independent vowels
+        self.a = next(c for c, t in CHAR_TOKENS.items() if t[0] == "" and t[1] == Cats.Base)
+        self.vowels["a"] = ""
+        self.reverse_i = next(c for c, t in CHAR_TOKENS.items() if t[2] == Special.I)
+        self.lengthener = self.vowels["ā"]
+        self.rl = {Special.R: (self.bases["r"], self.subscripts["r"]), Special.L: (self.bases["l"], self.subscripts["l"])}
+        # unit -> (unit, kind), with the precomposed and decomposed forms
+        self.trie = {}
+        for kind, table in [(Cats.Base, self.bases), (Cats.Vowel, self.vowels), (Cats.AfterVowel, self.marks), (Cats.Other, self.others)]:
+            for unit in table:
+                for form in {unit, unicodedata.normalize("NFC", unit), unicodedata.normalize("NFD", unit)}:
+                    node = self.trie
+                    for c in form:
+                        node = node.setdefault(c, {})
+                    node[None] = (unit, kind)
+
+    def tokenize(self, s):
+        ''' Yields (unit, kind) for the longest units of s, (char, None) for the chars
+        that are not in a unit'''
+        i = 0
+        n = len(s)
+        while i < n:
+            node = self.trie
+            match = None
+            j = i
+            while j < n:
+                node = node.get(s[j])
+                if node is None:
+                    break
+                j += 1
+                if None in node:
+                    match = node[None]
+                    end = j
+            if match is None:
+                yield s[i], None
+                i += 1
+            else:
+                yield match
+                i = end
+
+    def aksara(self, consonants, vowel):
+        if not consonants:
+            if vowel in VOCALIC_RL:
+                special, long = VOCALIC_RL[vowel]
+                return self.rl[special][0] + (self.lengthener if long else "") + self.reverse_i
+            return self.a + self.vowels[vowel]
+        res = self.bases[consonants[0]] + "".join(self.subscripts[c] for c in consonants[1:])
+        if vowel in VOCALIC_RL:
+            special, long = VOCALIC_RL[vowel]
+            return res + self.rl[special][1] + (self.lengthener if long else "") + self.reverse_i
+        return res + self.vowels[vowel]
+
+    def convert(self, s):
+        res = []
+        consonants = []
+        for unit, kind in self.tokenize(s):
+            if kind == Cats.Base:
+                consonants.append(unit)
+            elif kind == Cats.Vowel:
+                res.append(self.aksara(consonants, unit))
+                consonants = []
+            elif kind == Cats.AfterVowel:
+                if consonants:
+                    res.append(self.aksara(consonants, "a"))
+                    consonants = []
+                res.append(self.marks[unit])
+            else:
+                if consonants:
+                    # no vowel: virama
+                    res.append(self.aksara(consonants, "a") + VIRAMA)
+                    consonants = []
+                res.append(self.others[unit] if kind == Cats.Other else unit)
+        if consonants:
+            res.append(self.aksara(consonants, "a") + VIRAMA)
+        return normalize_unicode("".join(res))
+
+REVERSE_CONVERTER = None
+
+def iast_to_tibskrit(s):
+    ''' Converts IAST to normalized Tibetan, tibskrit_to_iast() gives back the same
+    IAST. Spaces become tshegs, consonants without a vowel get a virama and the
+    characters that are not IAST are kept as is.'''
+    global REVERSE_CONVERTER
+    if REVERSE_CONVERTER is None:
+        REVERSE_CONVERTER = ReverseConverter()
+    return REVERSE_CONVERTER.convert(s)
+
+# characters after which the text can be cut without changing the result:
+# they end a stack for unicode_reorder, are not involved in any
+# normalization rule and put the automaton back in its initial state.
+# Unless non_tibetan is "drop", the spans of non-Tibetan text are kept whole
+# so only newlines and Tibetan chars end them.
+def is_reset_char(c, non_tibetan="drop"):
+    if c == "\u0f00" or charcat(c) != OrderCats.Other:
+        return False
+    if non_tibetan != "drop" and c != "\n" and not "\u0f00" <= c <= "\u0fff":
+        return False
+    return c not in CHAR_TOKENS or CHAR_TOKENS[c][1] == Cats.Other
+
+def reset_point(s, start=0, non_tibetan="drop"):
+    ''' Returns the index after the last reset char of s[start:], 0 if there is none'''
+    for i in range(len(s) - 1, start - 1, -1):
+        if is_reset_char(s[i], non_tibetan):
+            return i + 1
+    return 0
+
+STREAM_CHUNK_SIZE = 65536
+
+def tibskrit_to_iast_iter(chunks, chunk_size=STREAM_CHUNK_SIZE, non_tibetan="drop", mark_format=MARK_FORMAT):
+    ''' Converts an iterable of strings or a text file object, yielding IAST chunks.
+    non_tibetan and mark_format are the same as for tibskrit_to_iast().
+
+    Input is buffered up to the last reset char so that a chunk boundary
+    can fall anywhere (even inside a stack), the concatenated output is
+    identical to tibskrit_to_iast() on the whole text. Memory is bounded
+    by the chunk size as long as the text has tshegs, shads or newlines.'''
+    if hasattr(chunks, "read"):
+        f = chunks
+        chunks = iter(lambda: f.read(chunk_size), "")
+    pending = ""
+    for chunk in chunks:
+        if not chunk:
+            continue
+        # the pending text has no reset char, only look at the new one
+        cut = reset_point(pending + chunk, len(pending), non_tibetan)
+        if cut == 0:
+            pending += chunk
+            continue
+        s = pending + chunk
+        pending = s[cut:]
+        yield tibskrit_to_iast(s[:cut], non_tibetan=non_tibetan, mark_format=mark_format)
+    if pending:
+        yield tibskrit_to_iast(pending, non_tibetan=non_tibetan, mark_format=mark_format)
+
+SHARD_SIZE = 1 << 20
+
+def split_text(s, size=SHARD_SIZE, non_tibetan="drop"):
+    ''' Splits s in pieces of about size characters that can be converted independently
+    with the non_tibetan policy, preferably after a newline, else after another reset char'''
+    pieces = []
+    start = 0
+    while len(s) - start > size:
+        end = s.rfind("\n", start, start + size) + 1
+        if end <= start:
+            end = start + reset_point(s[start:start + size], 0, non_tibetan)
+        if end <= start:
+            # no reset char in the window, keep the rest in one piece
+            break
+        pieces.append(s[start:end])
+        start = end
+    pieces.append(s[start:])
+    return pieces
+
+def read_item(item):
+    ''' Returns the text of a file if item is a path (os.PathLike), else item'''
+    if isinstance(item, os.PathLike):
+        return Path(item).read_text(encoding="utf-8")
+    return item
+
+def convert_many_iter(items, workers=None, shard_size=SHARD_SIZE, non_tibetan="drop", backend="python"):
+    ''' Converts texts (str) or files (os.PathLike) in a pool of processes, yields the IAST
+    of each item in the input order. Large texts are split with split_text().
+
+    Each worker imports the module once and keeps its syllable cache between tasks.'''
+    convert = partial(tibskrit_to_iast, non_tibetan=non_tibetan, backend=backend)
+    if workers == 1:
+        for item in items:
+            yield convert(read_item(item))
+        return
+    # imported here, multiprocessing takes longer to import than the rest of the module
+    from concurrent.futures import ProcessPoolExecutor
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # limit the number of texts in memory
+        pending = deque()
+        for item in items:
+            pending.append([executor.submit(convert, piece) for piece in split_text(read_item(item), shard_size, non_tibetan)])
+            while len(pending) > 2 * workers:
+                yield "".join(f.result() for f in pending.popleft())
+        while pending:
+            yield "".join(f.result() for f in pending.popleft())
+
+def convert_many(items, workers=None, shard_size=SHARD_SIZE, non_tibetan="drop", backend="python"):
+    ''' Returns the list of the IAST of texts or files, see convert_many_iter()'''
+    return list(convert_many_iter(items, workers, shard_size, non_tibetan, backend))
+
+# Line-oriented files start each line with a [folio.line] marker. Lines
+# are converted as (marker, text) records, the marker is put back before
+# the IAST instead of being dropped with the other non-Tibetan text.
+LINE_MARKER_RE = re.compile(r"\[[^\]\n]*\]")
+# number of records sent to a worker at once
+RECORD_CHUNK_SIZE = 256
+
+def parse_line(line):
+    ''' Returns the (marker, text) record of a line, the marker is "" if there is none'''
+    line = line.rstrip("\n")
+    m = LINE_MARKER_RE.match(line)
+    if m is None:
+        return "", line
+    return m.group(), line[m.end():]
+
+def read_records(lines):
+    ''' Yields the records of lines (for instance an open file), see parse_line()'''
+    for line in lines:
+        yield parse_line(line)
+
+def convert_records(records, non_tibetan="drop", backend="python", report=None):
+    ''' Returns the list of (marker, iast) of (marker, text) records. All the records are
+    converted by the same SyllableConverter. Their problems are added to report if it is
+    given, else summarized in one message.'''
+    log = report is None
+    if log:
+        report = ConversionReport()
+    res = []
+    pos = 0
+    for marker, text in records:
+        # the offsets of the problems are in the concatenation of the normalized texts
+        text = normalize_unicode(text, backend)
+        iast = CONVERTER.convert(text, report, non_tibetan, MARK_FORMAT, pos)
+        res.append((marker, iast))
+        pos += len(text)
+    if log and report:
+        logging.warning("conversion to IAST: %s", report.summary())
+    return res
+
+def convert_records_iter(records, workers=None, chunk_size=RECORD_CHUNK_SIZE, non_tibetan="drop", backend="python"):
+    ''' Converts (marker, text) records, yields (marker, iast) in the input order. records
+    can be a generator, it is consumed as the results are used.
+
+    With workers != 1, the records are sent by chunks of chunk_size to a pool of processes,
+    each converting them with its own SyllableConverter, kept between chunks.'''
+    if non_tibetan not in NON_TIBETAN_POLICIES:
+        raise ValueError("non_tibetan must be one of %s" % ", ".join(NON_TIBETAN_POLICIES))
+    records = iter(records)
+    def chunks():
+        while True:
+            chunk = list(islice(records, chunk_size))
+            if not chunk:
+                return
+            yield chunk
+    if workers == 1:
+        for chunk in chunks():
+            yield from convert_records(chunk, non_tibetan, backend)
+        return
+    from concurrent.futures import ProcessPoolExecutor
+    workers = workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        # limit the number of records in memory
+        pending = deque()
+        for chunk in chunks():
+            pending.append(executor.submit(convert_records, chunk, non_tibetan, backend))
+            while len(pending) > 2 * workers:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+FILE_WINDOW_SIZE = 1 << 22
+
+# UTF-8 encodings of reset chars where windows can end, by order of preference
+WINDOW_SEPARATORS = [b"\n", "།".encode("utf-8"), "་".encode("utf-8")]
+
+def window_end(mm, start, window):
+    ''' Returns the end of the window of mm starting at start, after a separator'''
+    if len(mm) - start <= window:
+        return len(mm)
+    for sep in WINDOW_SEPARATORS:
+        i = mm.rfind(sep, start, start + window)
+        if i >= 0:
+            return i + len(sep)
+    # no separator in the window, go to the next one
+    ends = [mm.find(sep, start + window) for sep in WINDOW_SEPARATORS]
+    ends = [i + len(sep) for i, sep in zip(ends, WINDOW_SEPARATORS) if i >= 0]
+    return min(ends) if ends else len(mm)
+
+def convert_file(src, dst, window=FILE_WINDOW_SIZE):
+    ''' Converts UTF-8 file src into dst. The input is memory-mapped and decoded by windows of
+    about window bytes ending on a line, shad or tsheg so that the memory used doesn't depend
+    on the size of the file. The result is the same as converting the whole text.'''
+    with open(src, "rb") as fin, open(dst, "w", encoding="utf-8") as fout:
+        if os.fstat(fin.fileno()).st_size == 0:
+            return
+        with mmap.mmap(fin.fileno(), 0, access=mmap.ACCESS_READ) as mm, memoryview(mm) as view:
+            start = 0
+            while start < len(mm):
+                end = window_end(mm, start, window)
+                s = str(view[start:end], "utf-8")
+                if "\r" in s:
+                    # universal newlines, like when the file is read in text mode
+                    s = s.replace("\r\n", "\n").replace("\r", "\n")
+                fout.write(tibskrit_to_iast(s))
+                start = end
+
+# Corpora converted again after each change of the rules can be kept
+# normalized in index files: the normalization is done once, and the files
+# that haven't changed since their last conversion with the same rules are
+# skipped.
+
+INDEX_SUFFIX = ".tibidx"
+INDEX_FORMAT = 1
+
+def normalization_version():
+    ''' Returns a checksum of the normalization tables, the index files are rebuilt when it changes'''
+    h = zlib.crc32(repr((sorted(DISCOURAGED.items()), CATEGORIES, SYLLABLE_RE.pattern)).encode("utf-8"))
+    for f in [normalize_unicode, normalize_run, sort_stack]:
+        h = code_checksum(f.__code__, h)
+    return h
+
+def content_hash(b):
+    import hashlib
+    return hashlib.blake2b(b, digest_size=16).hexdigest()
+
+class NormalizedText():
+    ''' Normalized and reordered text of a file, with the offsets of its syllables (as
+    matched by SYLLABLE_RE), the hash of the file and the version of the normalization.
+    conversion is the version of the rules and the options of the last conversion
+    written from it, if any.'''
+    def __init__(self, text, syllables, source_hash, normalization, conversion=None):
+        self.text = text
+        self.syllables = syllables
+        self.source_hash = source_hash
+        self.normalization = normalization
+        self.conversion = conversion
+
+    @classmethod
+    def build(cls, s, source_hash=None, backend="python"):
+        text = normalize_unicode(s, backend)
+        syllables = array("I", (m.start() for m in SYLLABLE_RE.finditer(text) if m.end() > m.start()))
+        return cls(text, syllables, source_hash, normalization_version())
+
+    def matches(self):
+        ''' Yields the groups of SYLLABLE_RE in each syllable, without searching the text'''
+        text = self.text
+        ends = self.syllables[1:]
+        ends.append(len(text))
+        # most syllables are repeated
+        groups = {}
+        for start, end in zip(self.syllables, ends):
+            syllable = text[start:end]
+            g = groups.get(syllable)
+            if g is None:
+                g = groups[syllable] = SYLLABLE_RE.fullmatch(syllable).groups("")
+            yield g
+
+    def syllable(self, i):
+        ''' Returns syllable i, with the separator after it'''
+        end = self.syllables[i + 1] if i + 1 < len(self.syllables) else len(self.text)
+        return self.text[self.syllables[i]:end]
+
+    def is_current(self, source_hash):
+        return self.source_hash == source_hash and self.normalization == normalization_version()
+
+    def to_bytes(self):
+        # the offsets are saved little-endian, and everything is compressed
+        # (fast level, about half the size of the UTF-8 source)
+        syllables = array("I", self.syllables)
+        if sys.byteorder == "big":
+            syllables.byteswap()
+        return zlib.compress(marshal.dumps((INDEX_FORMAT, self.source_hash, self.normalization, self.conversion, self.text, syllables.tobytes())), 1)
+
+    @classmethod
+    def from_bytes(cls, b):
+        index_format, source_hash, normalization, conversion, text, b = marshal.loads(zlib.decompress(b))
+        if index_format != INDEX_FORMAT:
+            raise ValueError("unknown index format %s" % index_format)
+        syllables = array("I")
+        syllables.frombytes(b)
+        if sys.byteorder == "big":
+            syllables.byteswap()
+        return cls(text, syllables, source_hash, normalization, conversion)
+
+    def save(self, path):
+        Path(path).write_bytes(self.to_bytes())
+
+    @classmethod
+    def load(cls, path):
+        return cls.from_bytes(Path(path).read_bytes())
+
+    def convert(self, report=None, non_tibetan="drop", mark_format=MARK_FORMAT):
+        ''' Returns the IAST of the text, like tibskrit_to_iast() without the normalization'''
+        if non_tibetan not in NON_TIBETAN_POLICIES:
+            raise ValueError("non_tibetan must be one of %s" % ", ".join(NON_TIBETAN_POLICIES))
+        log = report is None
+        if log:
+            report = ConversionReport()
+        res = CONVERTER.convert(self.text, report, non_tibetan, mark_format, matches=self.matches())
+        if log and report:
+            logging.warning("conversion to IAST: %s", report.summary())
+        return res
+
+def index_path(src, index_dir=None):
+    ''' Returns the path of the index of src: src + INDEX_SUFFIX, in index_dir if given'''
+    src = Path(src)
+    return Path(index_dir or src.parent).joinpath(src.name + INDEX_SUFFIX)
+
+def index_file(src, index_dir=None, backend="python"):
+    ''' Returns the NormalizedText of UTF-8 file src, from its index if it is up to
+    date, else normalized and saved in the index'''
+    b = Path(src).read_bytes()
+    source_hash = content_hash(b)
+    path = index_path(src, index_dir)
+    try:
+        index = NormalizedText.load(path)
+        if index.is_current(source_hash):
+            return index
+    except (OSError, EOFError, ValueError, TypeError, zlib.error):
+        pass
+    s = str(b, "utf-8")
+    if "\r" in s:
+        # universal newlines, like when the file is read in text mode
+        s = s.replace("\r\n", "\n").replace("\r", "\n")
+    index = NormalizedText.build(s, source_hash, backend)
+    index.save(path)
+    return index
+
+def convert_indexed(files, output_dir, index_dir=None, non_tibetan="drop", backend="python"):
+    ''' Converts files into output_dir (same names) from their indexes, see index_file().
+    Yields (path, converted), where converted is False if the file was skipped because
+    it, the rules and the options haven't changed since its output was written.'''
+    conversion = [dfa_version(), non_tibetan]
+    for src in files:
+        src = Path(src)
+        dst = Path(output_dir).joinpath(src.name)
+        index = index_file(src, index_dir, backend)
+        if index.conversion == conversion and dst.exists():
+            yield src, False
+            continue
+        dst.write_text(index.convert(non_tibetan=non_tibetan), encoding="utf-8")
+        index.conversion = conversion
+        index.save(index_path(src, index_dir))
+        yield src, True
+
+# Texts being edited are kept in segments ending with a newline or a shad:
+# both are reset chars, so the segments are converted independently and
+# the automaton is in its initial state at each boundary.
+SEGMENT_RE = re.compile("[^\n།]*[\n།]|[^\n།]+")
+# number of segments in a block, an edit converts the segments it touches
+# and moves the segments of at most a few blocks
+SEGMENT_BLOCK_SIZE = 64
+
+OutputChange = namedtuple("OutputChange", ["start", "end", "iast"])
+
+class IncrementalConverter():
+    ''' IAST of a text being edited. edit() only converts the segments that
+    changed and returns what changed in the output, the result is always the
+    same as tibskrit_to_iast(self.text()).
+
+    Problems found are not logged, they would be at each edit.'''
+    def __init__(self, s="", non_tibetan="drop", block_size=SEGMENT_BLOCK_SIZE):
+        self.non_tibetan = non_tibetan
+        self.block_size = block_size
+        # lists of [source, iast] segments, with their total lengths
+        self.blocks = []
+        self.src_lens = []
+        self.out_lens = []
+        self.replace_blocks(0, 0, self.convert_segments(s))
+
+    def text(self):
+        return "".join(src for block in self.blocks for src, _ in block)
+
+    def iast(self):
+        return "".join(out for block in self.blocks for _, out in block)
+
+    def convert_segments(self, s):
+        return [(seg, tibskrit_to_iast(seg, ConversionReport(), non_tibetan=self.non_tibetan)) for seg in SEGMENT_RE.findall(s)]
+
+    def replace_blocks(self, start, end, segments):
+        ''' Replaces blocks[start:end] by blocks of segments'''
+        blocks = [segments[i:i + self.block_size] for i in range(0, len(segments), self.block_size)]
+        self.blocks[start:end] = blocks
+        self.src_lens[start:end] = [sum(len(src) for src, _ in block) for block in blocks]
+        self.out_lens[start:end] = [sum(len(out) for _, out in block) for block in blocks]
+
+    def edit(self, offset, removed, inserted):
+        ''' Replaces the removed chars of the text at offset by inserted, returns the
+        OutputChange (start, end, iast) that replaces iast()[start:end] by iast'''
+        starts = list(accumulate(self.src_lens, initial=0))
+        if offset < 0 or removed < 0 or offset + removed > starts[-1]:
+            raise ValueError("edit out of the text")
+        if not self.blocks:
+            self.replace_blocks(0, 0, self.convert_segments(inserted))
+            return OutputChange(0, 0, self.iast())
+        # the edit can change the segment before the offset (if it has no separator),
+        # the segments it touches and the one after (if the separator is removed),
+        # which can be in the next block
+        first_block = min(bisect_right(starts, max(offset - 1, 0)) - 1, len(self.blocks) - 1)
+        last_block = min(bisect_right(starts, offset + removed) - 1, len(self.blocks) - 1)
+        last_block = min(last_block + 1, len(self.blocks) - 1)
+        segments = [seg for block in self.blocks[first_block:last_block + 1] for seg in block]
+        pos = starts[first_block]
+        out_pos = sum(self.out_lens[:first_block])
+        # segments i to j (included) are replaced
+        i = 0
+        while i < len(segments) - 1 and pos + len(segments[i][0]) < offset:
+            pos += len(segments[i][0])
+            out_pos += len(segments[i][1])
+            i += 1
+        j = i
+        end = pos + len(segments[j][0])
+        while j < len(segments) - 1 and end <= offset + removed:
+            j += 1
+            end += len(segments[j][0])
+        src = "".join(seg[0] for seg in segments[i:j + 1])
+        src = src[:offset - pos] + inserted + src[offset - pos + removed:]
+        if j < len(segments) - 1 and src and src[-1] not in "\n།":
+            j += 1
+            src += segments[j][0]
+        new_segments = self.convert_segments(src)
+        old_iast = "".join(seg[1] for seg in segments[i:j + 1])
+        new_iast = "".join(seg[1] for seg in new_segments)
+        segments[i:j + 1] = new_segments
+        self.replace_blocks(first_block, last_block + 1, segments)
+        # only the part of the output that changed
+        prefix = 0
+        while prefix < min(len(old_iast), len(new_iast)) and old_iast[prefix] == new_iast[prefix]:
+            prefix += 1
+        suffix = 0
+        while suffix < min(len(old_iast), len(new_iast)) - prefix and old_iast[-1 - suffix] == new_iast[-1 - suffix]:
+            suffix += 1
+        return OutputChange(out_pos + prefix, out_pos + len(old_iast) - suffix, new_iast[prefix:len(new_iast) - suffix])
+
+def main(argv=None):
+    import argparse
+    parser = argparse.ArgumentParser(description="Convert Sanskrit in Tibetan script to IAST. Runs the tests if no file is given.")
+    parser.add_argument("files", nargs="*", type=Path, help="UTF-8 files to convert")
+    parser.add_argument("-o", "--output-dir", type=Path, help="write the IAST of each file in this directory, with the same name (default: stdout)")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="number of processes (default: number of CPUs)")
+    parser.add_argument("--non-tibetan", choices=NON_TIBETAN_POLICIES, default="drop", help="what to do with non-Tibetan text such as folio markers (default: drop)")
+    parser.add_argument("--backend", choices=BACKENDS, default="python", help="normalize with numpy, if it is installed (default: python)")
+    parser.add_argument("--lines", action="store_true", help="convert line by line, keeping the [folio.line] marker at the start of each line")
+    parser.add_argument("--index-dir", type=Path, help="keep the normalized text of each file in this directory and only convert the files that changed since their last conversion (requires -o)")
+    args = parser.parse_args(argv)
+    if not args.files:
+        test()
+        return
+    if args.index_dir and not args.output_dir:
+        parser.error("--index-dir requires -o")
+    if args.output_dir:
+        args.output_dir.mkdir(parents=True, exist_ok=True)
+    start = time.perf_counter()
+    if args.index_dir:
+        args.index_dir.mkdir(parents=True, exist_ok=True)
+        converted = [src for src, done in convert_indexed(args.files, args.output_dir, args.index_dir, args.non_tibetan, args.backend) if done]
+        print("converted %d files, %d unchanged, in %.2fs" % (len(converted), len(args.files) - len(converted), time.perf_counter() - start), file=sys.stderr)
+        return
+    if args.lines:
+        nb_lines = 0
+        for path in args.files:
+            with open(path, encoding="utf-8") as fin, (open(args.output_dir.joinpath(path.name), "w", encoding="utf-8") if args.output_dir else nullcontext(sys.stdout)) as fout:
+                for marker, iast in convert_records_iter(read_records(fin), args.workers, non_tibetan=args.non_tibetan, backend=args.backend):
+                    fout.write("%s%s\n" % (marker, iast))
+                    nb_lines += 1
+        print("converted %d files, %d lines in %.2fs" % (len(args.files), nb_lines, time.perf_counter() - start), file=sys.stderr)
+        return
+    # the throughput is in input characters, the IAST is longer or shorter
+    sizes = []
+    def read(path):
+        s = read_item(path)
+        sizes.append(len(s))
+        return s
+    for path, res in zip(args.files, convert_many_iter(map(read, args.files), args.workers, non_tibetan=args.non_tibetan, backend=args.backend)):
+        if args.output_dir:
+            args.output_dir.joinpath(path.name).write_text(res, encoding="utf-8")
+        else:
+            sys.stdout.write(res)
+    duration = time.perf_counter() - start
+    nb_chars = sum(sizes)
+    print("converted %d files, %d characters in %.2fs (%d chars/s)" % (len(args.files), nb_chars, duration, nb_chars / duration if duration else 0), file=sys.stderr)
+
 def assert_conv(orig, expected):
     res = tibskrit_to_iast(orig)
     print("%s -> %s" % (orig, res))
@@ -420,6 +1670,312 @@ def test():
     assert_conv("བྷིཀྵཱུ", "bhikṣū")
     assert_conv("ཎཱཾ", "ṇāṃ")
     assert_conv("དུརྦྲྀཏྟཾ", "durbṛttaṃ")
+    test_normalize()
+    test_convert()
+    test_offsets()
+    test_dfa()
+    test_stream()
+    test_convert_many()
+    test_convert_file()
+    test_incremental()
+    test_stats()
+    test_reverse()
+    test_index()
+    test_schemes()
+    test_records()
+
+TEST_FILE = Path(__file__).parent.joinpath("tests", "D4155.txt")
+
+def test_normalize():
+    for s in ["\u0f40\u0f71\u0f72\u0f7a\u0f7a\u0f71\u0fb2", "\u0fb0\u0fb0\u0f71", "\u0f40\u0fb0", "\u0f71\u0f90\u0f71",
+              "\u0f7c\u0f7c\u0f7c\u0f40", "\u0f00\u0f7c", "\u0f56\u0f7e\u0fb7\u0f71\u0f74\u0f80\u0f81"]:
+        assert normalize_unicode(s) == normalize_unicode_reference(s)
+        assert unicode_reorder(s) == unicode_reorder_reference(s)
+    s = TEST_FILE.read_text(encoding="utf-8")
+    assert normalize_unicode(s) == normalize_unicode_reference(s)
+    assert unicode_reorder(s) == unicode_reorder_reference(s)
+    if import_numpy() is None:
+        print("normalization OK, numpy backend not tested")
+        return
+    for t in [s, "", "\u0f7a\u0f7a\u0f7a\u0f40\u0f7c\u0f7c\u0f7c\u0f7c", "\u0fb0\u0fb0\u0f71\u0f90\u0f71\u0f40\u0f71\u0fb0",
+              "\u0f72\u0f40\u0f7e\u0f90ab\u0f00", "\u0f42\u0f7a\u0fb7\u0f7a\u0f7a"]:
+        assert normalize_unicode(t, "numpy") == normalize_unicode_reference(t)
+        assert unicode_reorder(t, "numpy") == unicode_reorder_reference(t)
+    print("normalization OK, with numpy")
+
+def test_convert():
+    s = TEST_FILE.read_text(encoding="utf-8")
+    expected = tibskrit_to_iast_reference(s)
+    assert tibskrit_to_iast(s) == expected
+    converter = SyllableConverter(maxsize=16)
+    assert converter.convert(normalize_unicode(s)) == expected
+    info = converter.cache_info()
+    assert info.hits > 0 and info.currsize <= 16
+    report = ConversionReport()
+    assert tibskrit_to_iast("ཞ་ཀ\u0f80་ཞ", report) == " kii "
+    assert report.counts() == {"ཞ cannot be converted to IAST": 2, "reverse gigu should only be after l or r": 1}
+    assert report.offsets["ཞ cannot be converted to IAST"] == [0, 5]
+    report = ConversionReport()
+    tibskrit_to_iast("ཀ[1]ཞ", report)
+    assert report.offsets["ཞ cannot be converted to IAST"] == [4]
+    assert tibskrit_to_iast("ཀརྨ", trace=True) == "karma"
+    class Handler(logging.Handler):
+        def emit(self, record):
+            traced.append(record.getMessage())
+    traced = []
+    root = logging.getLogger()
+    handler, level = Handler(), root.level
+    root.addHandler(handler)
+    try:
+        root.setLevel(logging.INFO)
+        tibskrit_to_iast("ཀརྨ", trace=True)
+        assert traced == []
+        root.setLevel(logging.DEBUG)
+        tibskrit_to_iast("ཀརྨ", trace=True)
+        assert traced and all(m.startswith("new token") for m in traced)
+    finally:
+        root.removeHandler(handler)
+        root.setLevel(level)
+    s = "[1b.1]ཀརྨ། །lorem ipsum\nཔདྨ"
+    assert tibskrit_to_iast(s) == "karma||\npadma"
+    assert tibskrit_to_iast(s, non_tibetan="keep") == "[1b.1]karma||lorem ipsum\npadma"
+    assert tibskrit_to_iast(s, non_tibetan="mark") == "<[1b.1]>karma||<lorem ipsum>\npadma"
+    # the spaces around kept text are kept, the others are dropped
+    s = "lorem ipsum ཀརྨ dolor\tཀ  ཁ \n sit"
+    assert tibskrit_to_iast(s) == "karmakakha\n"
+    assert tibskrit_to_iast(s, non_tibetan="keep") == "lorem ipsum karma dolor\tkakha\n sit"
+    assert tibskrit_to_iast(s, non_tibetan="mark") == "<lorem ipsum> karma <dolor>\tkakha\n <sit>"
+    print("conversion OK, cache: %s" % str(CONVERTER.cache_info()))
+
+def test_offsets():
+    assert tibskrit_to_iast_with_offsets("ཀརྨ་") == ("karma ", array("I", [0, 0, 1, 2, 2, 3]))
+    # reordered, decomposed and merged
+    assert tibskrit_to_iast_with_offsets("ཀུྲ།\u0f00") == ("kru|oṃ", array("I", [0, 2, 1, 3, 4, 4]))
+    assert tibskrit_to_iast_with_offsets("ཀ\u0f7a\u0f7aཀ\u0f77") == ("kaikṝ", array("I", [0, 1, 1, 3, 4]))
+    s = TEST_FILE.read_text(encoding="utf-8")
+    norm, offsets = normalize_unicode_with_offsets(s)
+    assert norm == normalize_unicode(s) and len(offsets) == len(norm)
+    iast, offsets = tibskrit_to_iast_with_offsets(s)
+    assert iast == tibskrit_to_iast(s) and len(offsets) == len(iast)
+    for c, o in zip(iast, offsets):
+        if c == "|":
+            assert s[o] == "།"
+        elif c == "\n":
+            assert s[o] == "\n"
+    print("offsets OK")
+
+def test_dfa(max_len=3):
+    ''' Compares the DFA with the automaton on all the sequences of up to 2 chars,
+    and on all the sequences of up to max_len chars of one char per token kind'''
+    dfa = TransliterationDFA.build()
+    assert TransliterationDFA.from_bytes(dfa.to_bytes()).emits == dfa.emits
+    import tempfile
+    with tempfile.TemporaryDirectory() as d:
+        path = Path(d).joinpath("tibskritconv.dfa")
+        path.write_bytes(b"old")
+        write_atomic(path, dfa.to_bytes())
+        assert TransliterationDFA.from_bytes(path.read_bytes()).emits == dfa.emits
+        assert os.listdir(d) == [path.name]
+        if os.name == "posix":
+            umask = os.umask(0)
+            os.umask(umask)
+            assert path.stat().st_mode & 0o777 == 0o644 & ~umask
+    def check(s):
+        state = StateAutomaton()
+        convert_chars(state, s)
+        assert dfa.run(s) == (state.get_result(), state.diagnostics), s
+    chars = [c for c in CHAR_TOKENS if len(c) == 1] + NON_SANSKRIT_CHARS + ["\n", "a"]
+    for c in chars:
+        for d in chars:
+            check(c + d)
+    kinds = {}
+    for c in chars:
+        kinds.setdefault(CHAR_TOKENS[c][1:] if c in CHAR_TOKENS else c, c)
+    kinds = list(kinds.values())
+    sequences = [""]
+    for _ in range(max_len):
+        sequences = [seq + c for seq in sequences for c in kinds]
+        for seq in sequences:
+            check(seq)
+    s = normalize_unicode(TEST_FILE.read_text(encoding="utf-8"))
+    check(s[:20000])
+    print("DFA OK: %d states, %d classes, %d sequences of %d chars" % (len(dfa.finals), dfa.nb_classes, len(sequences), max_len))
+
+def test_stream():
+    s = TEST_FILE.read_text(encoding="utf-8")
+    expected = tibskrit_to_iast(s)
+    # chunk boundaries inside stacks, lines and syllables
+    for size in [1, 7, 1000, 65536]:
+        chunks = (s[i:i+size] for i in range(0, len(s), size))
+        assert "".join(tibskrit_to_iast_iter(chunks)) == expected
+    with open(TEST_FILE, encoding="utf-8") as f:
+        assert "".join(tibskrit_to_iast_iter(f, chunk_size=4096)) == expected
+    # non-Tibetan spans with spaces are not cut when they are kept
+    s = "ཀ་a b\tc།ཀ [1a.2] " * 20
+    for non_tibetan in NON_TIBETAN_POLICIES:
+        expected = tibskrit_to_iast(s, non_tibetan=non_tibetan)
+        chunks = (s[i:i+3] for i in range(0, len(s), 3))
+        assert "".join(tibskrit_to_iast_iter(chunks, non_tibetan=non_tibetan)) == expected
+    print("streaming conversion OK")
+
+def test_convert_many():
+    s = TEST_FILE.read_text(encoding="utf-8")
+    expected = tibskrit_to_iast(s)
+    pieces = split_text(s, 10000)
+    assert len(pieces) > 1 and "".join(pieces) == s
+    t = "ཀ་a b c།" * 10
+    assert split_text(t, 6, "mark") == ["ཀ་", "a b c།"] * 10 and split_text(t, 6)[0] == "ཀ་a b "
+    assert convert_many([t], workers=2, shard_size=6, non_tibetan="mark") == [tibskrit_to_iast(t, non_tibetan="mark")]
+    assert convert_many([s, TEST_FILE, "ཀརྨ"], workers=2, shard_size=10000) == [expected, expected, "karma"]
+    print("batch conversion OK")
+
+def test_convert_file():
+    import tempfile
+    s = TEST_FILE.read_text(encoding="utf-8")
+    with tempfile.TemporaryDirectory() as d:
+        dst = Path(d).joinpath("D4155.iast.txt")
+        for window in [1000, FILE_WINDOW_SIZE]:
+            convert_file(TEST_FILE, dst, window)
+            assert dst.read_text(encoding="utf-8") == tibskrit_to_iast(s)
+        src = Path(d).joinpath("crlf.txt")
+        src.write_bytes("ཀརྨ།\r\nཀརྨ\r".encode("utf-8"))
+        convert_file(src, dst, 3)
+        assert dst.read_text(encoding="utf-8") == tibskrit_to_iast(src.read_text(encoding="utf-8"))
+    print("file conversion OK")
+
+def test_incremental():
+    import random
+    s = TEST_FILE.read_text(encoding="utf-8")[:20000]
+    converter = IncrementalConverter(s, block_size=4)
+    iast = tibskrit_to_iast(s)
+    assert converter.iast() == iast
+    rnd = random.Random(0)
+    inserts = ["", "ཀ", "\u0f71", "\n", "།", "་", "ཀརྨ་", "ར\u0fb2\u0f80", "\n\n།ab"]
+    for _ in range(300):
+        offset = rnd.randint(0, len(s))
+        removed = rnd.randint(0, min(len(s) - offset, rnd.choice([0, 2, 10, 300])))
+        inserted = rnd.choice(inserts)
+        start, end, res = converter.edit(offset, removed, inserted)
+        s = s[:offset] + inserted + s[offset + removed:]
+        iast = iast[:start] + res + iast[end:]
+        assert iast == tibskrit_to_iast(s, ConversionReport()) == converter.iast() and converter.text() == s
+    converter.edit(0, len(s), "")
+    assert converter.iast() == "" and converter.edit(0, 0, "ཀརྨ") == (0, 0, "karma")
+    print("incremental conversion OK")
+
+def test_stats():
+    s = TEST_FILE.read_text(encoding="utf-8")
+    iast, stats = tibskrit_to_iast_with_stats(s, report=ConversionReport())
+    assert iast == tibskrit_to_iast(s, ConversionReport())
+    assert stats.calls == 1 and stats.chars == len(s) and stats.normalized_chars == len(normalize_unicode(s))
+    assert stats.non_sanskrit == 429 + 53 + 94
+    assert stats.cache_hits + stats.cache_misses > 0 and all(t > 0 for t in stats.seconds.values())
+    calls = []
+    set_metrics_callback(calls.append)
+    try:
+        assert tibskrit_to_iast("\u0f71\u0f40\u0f72\u0f71", backend="numpy") == "kī"
+    finally:
+        set_metrics_callback(None)
+    assert len(calls) == 1 and calls[0].orphan_marks == 1 and calls[0].stacks_reordered == 1
+    stats.add(calls[0])
+    assert stats.as_dict()["calls"] == 2
+    print("stats OK: %s" % stats.summary())
+
+def test_reverse():
+    import unicodedata
+    for iast, tib in [("karma", "ཀརྨ"), ("durbṛttaṃ", "དུརྦྲྀཏྟཾ"), ("vāk", "ཝཱཀ\u0f84"), ("ṛṣi", "རྀཥི"),
+                      ("ghoṣa", "ག\u0fb7ོཥ"), ("oṃ a|", "ཨོཾ་ཨ།"), ("mṝta", normalize_unicode("མ\u0f77ཏ")),
+                      ("hūṃ", "ཧཱུཾ"), ("bhikṣu", "བ\u0fb7ིཀ\u0fb5ུ"), ("cittaṃ", "ཙིཏྟཾ")]:
+        assert iast_to_tibskrit(iast) == tib
+        assert tibskrit_to_iast(tib) == iast
+    s = TEST_FILE.read_text(encoding="utf-8")
+    iast = tibskrit_to_iast(s, ConversionReport())
+    assert tibskrit_to_iast(iast_to_tibskrit(iast), ConversionReport()) == iast
+    # Tibetan -> IAST -> Tibetan gives back the syllables of the text, except the
+    # ones the IAST can't tell apart: with chars converted like another one
+    # (ཅ and ཙ, ཪ and ར...) or precomposed (ཀྵ and ཀ + ྵ), with a problem, a
+    # subscript or mark without a base, a mark dropped by the conversion (ཱ
+    # before ེ, ཾ before ཿ...), or an aspirate that has its own letter written
+    # with a subscript h (པ + ྷ and ཕ are both "ph")
+    alternatives = {c for c, (unit, cat, _) in CHAR_TOKENS.items()
+                    if unit in REVERSE_CHARS.get(cat, {}) and c != REVERSE_CHARS[cat][unit]}
+    silent = ["ཨ", "\u0f84"]
+    checked = 0
+    for syl in set(re.split("[^%s]+" % SYLLABLE_CHARS, normalize_unicode(s))):
+        if (not syl or charcat(syl[0]) != OrderCats.Base or re.search("[ཀཅཙཊཏཔ]\u0fb7", syl)
+                or any(c in alternatives or unicodedata.decomposition(c) for c in syl)):
+            continue
+        report = ConversionReport()
+        if tibskrit_to_iast(syl, report) and report:
+            continue
+        syl_iast, offsets = tibskrit_to_iast_with_offsets(syl)
+        if set(range(len(syl))) - set(offsets) - {i for i, c in enumerate(syl) if c in silent}:
+            continue
+        assert iast_to_tibskrit(syl_iast) == syl, syl
+        checked += 1
+    assert checked > 8000
+    print("reverse conversion OK, %d syllables of %s converted back" % (checked, TEST_FILE.name))
+
+def test_index():
+    import tempfile
+    s = TEST_FILE.read_text(encoding="utf-8")
+    with tempfile.TemporaryDirectory() as d:
+        src = Path(d).joinpath("D4155.txt")
+        src.write_text(s, encoding="utf-8")
+        out = Path(d).joinpath("out")
+        out.mkdir()
+        index = index_file(src)
+        assert index.text == normalize_unicode(s) and index_path(src).exists()
+        assert "".join(index.syllable(i) for i in range(len(index.syllables))) == index.text
+        assert NormalizedText.load(index_path(src)).syllables == index.syllables
+        assert list(index.matches()) == [m for m in SYLLABLE_RE.findall(index.text) if any(m)]
+        assert index.convert(ConversionReport()) == tibskrit_to_iast(s, ConversionReport())
+        report, expected = ConversionReport(), ConversionReport()
+        assert index.convert(report, non_tibetan="mark") == tibskrit_to_iast(s, expected, non_tibetan="mark")
+        assert report.offsets == expected.offsets
+        assert [done for _, done in convert_indexed([src], out)] == [True]
+        assert [done for _, done in convert_indexed([src], out)] == [False]
+        assert [done for _, done in convert_indexed([src], out, non_tibetan="keep")] == [True]
+        src.write_text("ཀརྨ\r\n", encoding="utf-8", newline="")
+        assert [done for _, done in convert_indexed([src], out)] == [True]
+        assert out.joinpath(src.name).read_text(encoding="utf-8") == "karma\n"
+    print("index OK")
+
+def test_schemes():
+    res = tibskrit_to_schemes("བྷིཀྵཱུ་ཎཱཾ་དུརྦྲྀཏྟཾ།ཨཻ\u0f83", report=ConversionReport())
+    assert res == {"iast": "bhikṣū ṇāṃ durbṛttaṃ|ai" + ANUNASIKA_CHARACTER, "iso15919": "bhikṣū ṇāṁ durbr\u0325ttaṁ|ai" + ANUNASIKA_CHARACTER,
+                   "hk": "bhikSU NAM durbRttaM|ai~", "slp1": "BikzU RAM durbfttaM|E~"}
+    assert tibskrit_to_schemes("ཁ་ག\u0fb7་དྷ", ["slp1"])["slp1"] == "Ka Ga Da"
+    # the h of another aksara is not an aspiration
+    assert tibskrit_to_schemes("ཀ྄ཧ་ཀྷ", ["slp1", "hk"], ConversionReport()) == {"slp1": "kha Ka", "hk": "kha kha"}
+    s = TEST_FILE.read_text(encoding="utf-8")
+    res = tibskrit_to_schemes(s, report=ConversionReport(), non_tibetan="mark")
+    assert res["iast"] == tibskrit_to_iast(s, ConversionReport(), non_tibetan="mark")
+    # same as the automaton writing in each scheme
+    norm = normalize_unicode(s)
+    for scheme, units in SCHEMES.items():
+        out = []
+        def write(u, offset):
+            out.append(SUBSCRIPT_H if u == "h" and norm[offset] == SUBSCRIPT_H else units.get(u, u))
+        state = StateAutomaton(write)
+        convert_chars(state, norm)
+        state.get_result()
+        assert join_clusters("".join(out), scheme) == tibskrit_to_schemes(s, [scheme], ConversionReport())[scheme]
+    print("schemes OK")
+
+def test_records():
+    s = TEST_FILE.read_text(encoding="utf-8")
+    lines = s.splitlines(keepends=True)
+    assert parse_line("[1b.1]ཀརྨ\n") == ("[1b.1]", "ཀརྨ") and parse_line("ཀ[1]") == ("", "ཀ[1]")
+    assert list(convert_records_iter([("[1b.1]", "ཀརྨ[x]"), ("", "པདྨ")], 1)) == [("[1b.1]", "karma"), ("", "padma")]
+    report = ConversionReport()
+    convert_records([("", "ༀཞ"), ("", "ཞ")], report=report)
+    assert report.offsets == {"ཞ cannot be converted to IAST": [3, 4]}
+    expected = tibskrit_to_iast(s, ConversionReport(), non_tibetan="keep")
+    for workers in [1, 2]:
+        res = convert_records_iter(read_records(iter(lines)), workers, chunk_size=100, non_tibetan="keep")
+        assert "".join("%s%s\n" % record for record in res) == expected
+    print("records OK")
 
 if __name__ == "__main__":
-    test()
\ No newline at end of file
+    main()
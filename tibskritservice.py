@@ -0,0 +1,310 @@
+import io
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+
+from tibskritconv import tibskrit_to_iast, TEST_FILE
+
+# requests are grouped in batches of at most BATCH_SIZE texts and
+# BATCH_CHARS characters, waiting at most BATCH_DELAY seconds for more
+BATCH_SIZE = 64
+BATCH_CHARS = 65536
+BATCH_DELAY = 0.002
+MAX_QUEUE = 1024
+# number of latencies kept for the percentiles
+LATENCY_WINDOW = 10000
+
+def convert_batch(texts):
+    ''' Returns the IAST of each text, or the exception raised by its conversion'''
+    results = []
+    for s in texts:
+        try:
+            results.append(tibskrit_to_iast(s))
+        except Exception as e:
+            results.append(e)
+    return results
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+class ConversionService():
+    ''' Converts texts in a pool of processes without blocking the event loop.
+
+    Small concurrent requests are grouped in batches, and convert() waits
+    when more than max_queue requests are pending (backpressure).'''
+    def __init__(self, workers=None, max_queue=MAX_QUEUE, batch_size=BATCH_SIZE, batch_chars=BATCH_CHARS, batch_delay=BATCH_DELAY):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.batch_chars = batch_chars
+        self.batch_delay = batch_delay
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.nb_requests = 0
+        self.nb_batches = 0
+        self.queue = None
+        self.executor = None
+        self.running = None
+        self.batcher = None
+        # batches being converted
+        self.tasks = set()
+
+    async def start(self):
+        self.queue = asyncio.Queue(self.max_queue)
+        workers = self.workers or os.cpu_count() or 1
+        self.executor = ProcessPoolExecutor(max_workers=workers)
+        # one batch per worker at most, the others wait in the queue
+        self.running = asyncio.Semaphore(workers)
+        self.batcher = asyncio.create_task(self.make_batches())
+
+    async def stop(self):
+        # the requests already queued are converted first
+        await self.queue.join()
+        self.batcher.cancel()
+        try:
+            await self.batcher
+        except asyncio.CancelledError:
+            pass
+        await asyncio.gather(*self.tasks)
+        # in case a request was queued after the join
+        while not self.queue.empty():
+            _, future = self.queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError("conversion service stopped"))
+        await asyncio.get_running_loop().run_in_executor(None, self.executor.shutdown)
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.stop()
+
+    async def convert(self, s):
+        ''' Returns the IAST of s'''
+        if not isinstance(s, str):
+            raise TypeError("text must be a str, not %s" % type(s).__name__)
+        start = time.perf_counter()
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((s, future))
+        res = await future
+        self.latencies.append(time.perf_counter() - start)
+        self.nb_requests += 1
+        return res
+
+    async def make_batches(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = []
+            try:
+                batch.append(await self.queue.get())
+                nb_chars = len(batch[0][0])
+                deadline = loop.time() + self.batch_delay
+                while len(batch) < self.batch_size and nb_chars < self.batch_chars:
+                    timeout = deadline - loop.time()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                    batch.append(item)
+                    nb_chars += len(item[0])
+            except Exception as e:
+                # a bad item fails its batch, not the batcher
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                    self.queue.task_done()
+                continue
+            await self.running.acquire()
+            # the loop only keeps weak references to the tasks
+            task = asyncio.create_task(self.run_batch(batch))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def run_batch(self, batch):
+        try:
+            results = await asyncio.get_running_loop().run_in_executor(self.executor, convert_batch, [s for s, _ in batch])
+            for (_, future), res in zip(batch, results):
+                if future.done():
+                    pass
+                elif isinstance(res, Exception):
+                    future.set_exception(res)
+                else:
+                    future.set_result(res)
+        except Exception as e:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+        finally:
+            self.nb_batches += 1
+            self.running.release()
+            for _ in batch:
+                self.queue.task_done()
+
+    def stats(self):
+        ''' Returns latency percentiles (in ms), queue depth and counters'''
+        latencies = list(self.latencies)
+        return {
+            "requests": self.nb_requests,
+            "batches": self.nb_batches,
+            "queue_depth": self.queue.qsize() if self.queue else 0,
+            "p50_ms": percentile(latencies, 50) * 1000,
+            "p99_ms": percentile(latencies, 99) * 1000,
+            }
+
+async def serve_jsonl(service, fin=sys.stdin, fout=sys.stdout):
+    ''' Reads {"id": ..., "text": ...} lines on fin, writes {"id": ..., "iast": ...} lines
+    on fout as soon as each conversion is done'''
+    loop = asyncio.get_running_loop()
+    pending = set()
+
+    async def handle(line):
+        req = {}
+        try:
+            req = json.loads(line)
+            res = {"id": req.get("id"), "iast": await service.convert(req["text"])}
+        except Exception as e:
+            # malformed request or failed conversion, answered all the same
+            res = {"id": req.get("id") if isinstance(req, dict) else None, "error": "%s: %s" % (type(e).__name__, e)}
+        fout.write(json.dumps(res, ensure_ascii=False) + "\n")
+        fout.flush()
+
+    while True:
+        line = await loop.run_in_executor(None, fin.readline)
+        if not line:
+            break
+        if line.strip():
+            task = asyncio.create_task(handle(line))
+            pending.add(task)
+            task.add_done_callback(pending.discard)
+    if pending:
+        await asyncio.gather(*pending)
+    print(json.dumps(service.stats()), file=sys.stderr)
+
+async def http_response(service, reader, request_line, headers):
+    ''' Returns the status and the JSON object answering a request'''
+    try:
+        length = int(headers.get("content-length", 0))
+        if length < 0:
+            raise ValueError("negative length %d" % length)
+        body = (await reader.readexactly(length)).decode("utf-8")
+    except UnicodeDecodeError as e:
+        return "400 Bad Request", {"error": "body is not UTF-8: %s" % e}
+    except (ValueError, asyncio.IncompleteReadError) as e:
+        return "400 Bad Request", {"error": "bad content-length: %s" % e}
+    route = request_line[:2]
+    if route == ["POST", "/convert"]:
+        try:
+            return "200 OK", {"iast": await service.convert(body)}
+        except Exception as e:
+            return "500 Internal Server Error", {"error": "%s: %s" % (type(e).__name__, e)}
+    if route == ["GET", "/stats"]:
+        return "200 OK", service.stats()
+    return "404 Not Found", {"error": "POST /convert or GET /stats"}
+
+async def handle_http(service, reader, writer):
+    ''' Minimal HTTP/1.1: POST /convert with the text as body, GET /stats'''
+    try:
+        request_line = (await reader.readline()).decode("latin-1").split()
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode("latin-1").strip()
+            if not line:
+                break
+            name, _, value = line.partition(":")
+            headers[name.strip().lower()] = value.strip()
+        status, res = await http_response(service, reader, request_line, headers)
+        data = json.dumps(res, ensure_ascii=False).encode("utf-8")
+        writer.write(("HTTP/1.1 %s\r\nContent-Type: application/json; charset=utf-8\r\nContent-Length: %d\r\nConnection: close\r\n\r\n" % (status, len(data))).encode("latin-1") + data)
+        await writer.drain()
+    finally:
+        writer.close()
+
+async def serve_http(service, host, port):
+    server = await asyncio.start_server(lambda r, w: handle_http(service, r, w), host, port)
+    print("listening on http://%s:%d" % (host, port), file=sys.stderr)
+    async with server:
+        await server.serve_forever()
+
+async def run(args):
+    async with ConversionService(args.workers, args.max_queue) as service:
+        if args.http is not None:
+            await serve_http(service, args.host, args.http)
+        else:
+            await serve_jsonl(service)
+
+async def test_service():
+    s = TEST_FILE.read_text(encoding="utf-8")
+    lines = s.splitlines(keepends=True)[:200]
+    async with ConversionService(workers=2, max_queue=16) as service:
+        # more concurrent requests than the queue can hold
+        results = await asyncio.gather(*[service.convert(line) for line in lines])
+        assert results == [tibskrit_to_iast(line) for line in lines]
+        assert await service.convert(s) == tibskrit_to_iast(s)
+        stats = service.stats()
+        assert stats["requests"] == len(lines) + 1 and stats["batches"] < len(lines)
+        print("service OK: %s" % stats)
+    # stopping converts the requests still queued
+    service = ConversionService(workers=1)
+    await service.start()
+    pending = [asyncio.ensure_future(service.convert(line)) for line in lines[:20]]
+    await asyncio.sleep(0)
+    await service.stop()
+    assert [f.result() for f in pending] == [tibskrit_to_iast(line) for line in lines[:20]]
+    async with ConversionService(workers=1) as service:
+        # malformed requests get an error
+        fout = io.StringIO()
+        await serve_jsonl(service, io.StringIO('{"id": 1, "text": "ཀརྨ"}\nnot json\n{"id": 3}\n{"id": 4, "text": 123}\n{"id": 5, "text": "ཀརྨ"}\n'), fout)
+        replies = {r["id"]: r for r in map(json.loads, fout.getvalue().splitlines())}
+        assert replies[1]["iast"] == "karma" and "JSONDecodeError" in replies[None]["error"] and "KeyError" in replies[3]["error"]
+        assert "TypeError" in replies[4]["error"] and replies[5]["iast"] == "karma"
+        # an item the batcher cannot measure only fails its own batch
+        future = asyncio.get_running_loop().create_future()
+        await service.queue.put((None, future))
+        try:
+            await future
+            assert False
+        except TypeError:
+            pass
+        assert await service.convert("ཀརྨ") == "karma"
+        # a failed conversion does not fail the other requests of its batch
+        future = asyncio.get_running_loop().create_future()
+        await service.queue.put((["x"], future))
+        results = await asyncio.gather(future, service.convert("ཀརྨ"), return_exceptions=True)
+        assert isinstance(results[0], AttributeError) and results[1] == "karma", results
+        server = await asyncio.start_server(lambda r, w: handle_http(service, r, w), "127.0.0.1", 0)
+        async with server:
+            for request, status in [(b"POST /convert HTTP/1.1\r\nContent-Length: 9\r\n\r\n\xe0\xbd\x80\xe0\xbd\xa2\xe0\xbe\xa8", b"200"),
+                                    (b"POST /convert HTTP/1.1\r\nContent-Length: x\r\n\r\n", b"400"),
+                                    (b"POST /convert HTTP/1.1\r\nContent-Length: 2\r\n\r\n\xff\xff", b"400")]:
+                reader, writer = await asyncio.open_connection(*server.sockets[0].getsockname()[:2])
+                writer.write(request)
+                response = await reader.read()
+                writer.close()
+                assert response.split()[1] == status, response
+    print("service errors OK")
+
+def test():
+    asyncio.run(test_service())
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Conversion service: JSON lines on stdin/stdout or HTTP. Runs the tests if no mode is given.")
+    parser.add_argument("--jsonl", action="store_true", help="read {\"id\", \"text\"} JSON lines on stdin, write {\"id\", \"iast\"} lines on stdout")
+    parser.add_argument("--http", type=int, metavar="PORT", help="serve POST /convert and GET /stats on this port")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("-j", "--workers", type=int, default=None, help="number of processes (default: number of CPUs)")
+    parser.add_argument("--max-queue", type=int, default=MAX_QUEUE, help="maximum number of pending requests")
+    args = parser.parse_args()
+    if args.jsonl or args.http is not None:
+        asyncio.run(run(args))
+    else:
+        test()
@@ -0,0 +1,313 @@
+import re
+from enum import Enum
+
+# Tables and functions shared by tibskritconv.py and normalize_unicode.py:
+# the categories used to reorder the characters of a stack, the reordering
+# and the normalization of the runs of characters after a base.
+
+class OrderCats(Enum):
+    Other = 0
+    Base = 1
+    Subscript = 2
+    BottomVowel = 3
+    BottomMark = 4
+    TopVowel = 5
+    TopMark = 6
+    RightMark = 7
+
+CATEGORIES =  ([OrderCats.Other]           # 0F00
+             + [OrderCats.Base]            # 0F01, often followed by 0f083
+             + [OrderCats.Other] * 22      # 0F02-0F17
+             + [OrderCats.BottomVowel] * 2 # 0F18-0F19
+             + [OrderCats.Other] * 6       # 0F1A-0F1F
+             + [OrderCats.Base] * 20       # 0F20-0F33, numbers can be followed by 0f18, 0f19 or exceptionally by vowels
+             + [OrderCats.Other]           # 0F34
+             + [OrderCats.BottomMark]      # 0F35
+             + [OrderCats.Other]           # 0F36
+             + [OrderCats.BottomMark]      # OF37
+             + [OrderCats.Other]           # 0F38
+             + [OrderCats.Subscript]       # 0F39, kind of cheating but works
+             + [OrderCats.Other] * 4       # 0F3A-0F3D
+             + [OrderCats.RightMark]       # 0F3E
+             + [OrderCats.Other]           # 0F3F, not quite sure
+             + [OrderCats.Base] * 45       # 0F40-0F6C
+             + [OrderCats.Other] * 4       # 0F6D-0F70
+             + [OrderCats.BottomVowel]     # 0F71
+             + [OrderCats.TopVowel]        # 0F72
+             + [OrderCats.TopVowel]        # 0F73
+             + [OrderCats.BottomVowel] * 2 # 0F74-0F75
+             + [OrderCats.TopVowel] * 8    # 0F76-0F7D
+             + [OrderCats.TopMark]         # 0F7E
+             + [OrderCats.RightMark]       # 0F7F
+             + [OrderCats.TopVowel] * 2    # 0F80-0F81
+             + [OrderCats.TopMark] * 2     # 0F82-0F83
+             + [OrderCats.BottomMark]      # 0F84
+             + [OrderCats.Other]           # 0F85
+             + [OrderCats.TopMark] * 2     # 0F86-0F87
+             + [OrderCats.Base] * 2        # 0F88-0F89
+             + [OrderCats.Base]            # 0F8A always followed by 0f82 (required by the Unicode spec)
+             + [OrderCats.Other]           # 0F8B
+             + [OrderCats.Base]            # 0F8C
+             + [OrderCats.Subscript] * 48  # 0F8D-0FBC
+             )
+
+def charcat(c):
+    ''' Returns the category for a single char string'''
+    o = ord(c)
+    if 0x0F00 <= o <= 0x0FBC:
+        return CATEGORIES[o-0x0F00]
+    return OrderCats.Other
+
+# debug:
+#for i, c in enumerate(CATEGORIES):
+#    print("%x : %d" % (0x0F00 + i , c.value))
+
+def char_class(cat):
+    ''' Returns a regex character class matching the chars of a category in CATEGORIES'''
+    ranges = []
+    for i, c in enumerate(CATEGORIES):
+        if cat(c):
+            if ranges and ranges[-1][1] == i - 1:
+                ranges[-1][1] = i
+            else:
+                ranges.append([i, i])
+    return "[" + "".join(chr(0x0F00+a) if a == b else "%s-%s" % (chr(0x0F00+a), chr(0x0F00+b)) for a, b in ranges) + "]"
+
+# category values as characters, to get the sort keys of a stack with
+# one str.translate()
+CATEGORY_KEYS = str.maketrans({chr(0x0F00+i): chr(c.value) for i, c in enumerate(CATEGORIES)})
+
+BASE_CLASS = char_class(lambda c: c == OrderCats.Base)
+MARK_CLASS = char_class(lambda c: c.value > OrderCats.Base.value)
+# stacks with at least 2 marks, the others are always in order
+STACK_RE = re.compile("%s%s{2,}" % (BASE_CLASS, MARK_CLASS))
+# marks that don't follow a base
+ORPHAN_MARK_RE = re.compile("(?<!%s|%s)%s" % (BASE_CLASS, MARK_CLASS, MARK_CLASS))
+
+def sort_stack(stack):
+    ''' Sorts the characters of a stack by category, keeping the order of characters of the same category'''
+    keys = stack.translate(CATEGORY_KEYS)
+    if keys == "".join(sorted(keys)):
+        return stack
+    return "".join(stack[n] for n in sorted(range(len(stack)), key=keys.__getitem__))
+
+def unicode_reorder(txt, backend="python"):
+    if backend != "python":
+        normalizer = numpy_normalizer(backend)
+        if normalizer is not None:
+            a, valid = normalizer.reorder(normalizer.to_array(txt))
+            return normalizer.to_str(a), valid
+    # inpired from code for Khmer Unicode provided by SIL
+    # https://docs.microsoft.com/en-us/typography/script-development/tibetan#reor
+    # https://docs.microsoft.com/en-us/typography/script-development/use#glyph-reordering
+    # find subranges of base+non other and sort components in the subrange
+    valid = ORPHAN_MARK_RE.search(txt) is None
+    return STACK_RE.sub(lambda m: sort_stack(m.group()), txt), valid
+
+def unicode_reorder_reference(txt):
+    # straightforward version of unicode_reorder(), kept to check it
+    # inpired from code for Khmer Unicode provided by SIL
+    # https://docs.microsoft.com/en-us/typography/script-development/tibetan#reor
+    # https://docs.microsoft.com/en-us/typography/script-development/use#glyph-reordering
+    charcats = [charcat(c) for c in txt]
+    # find subranges of base+non other and sort components in the subrange
+    i = 0
+    res = []
+    valid = True
+    while i < len(charcats):
+        c = charcats[i]
+        if c != OrderCats.Base:
+            if c.value > OrderCats.Base.value:
+                valid = False
+            res.append(txt[i])
+            i += 1
+            continue
+        # scan for end of component
+        j = i + 1
+        while j < len(charcats) and charcats[j].value > OrderCats.Base.value:
+            j += 1
+        # sort syllable based on character categories
+        # sort the char indices by category then position in string
+        newindices = sorted(range(i, j), key=lambda e:(charcats[e].value, e))
+        replaces = "".join(txt[n] for n in newindices)
+        res.append(replaces)
+        i = j
+    return "".join(res), valid
+
+# deprecated or discouraged characters
+DISCOURAGED = {
+    "\u0f73": "\u0f71\u0f72", # use is discouraged
+    "\u0f75": "\u0f71\u0f74", # use is discouraged
+    "\u0f77": "\u0fb2\u0f71\u0f80", # deprecated
+    "\u0f79": "\u0fb3\u0f71\u0f80", # deprecated
+    "\u0f81": "\u0f71\u0f80", # use is discouraged
+    # 0f00 has not been marked as a composed character in Unicode
+    # This is something that is now seen as a mistake, but it cannot be
+    # changed because of Unicode change policies.
+    "\u0f00": "\u0f68\u0f7c\u0f7e",
+    }
+
+# no 0f71 in the middle of stacks, only 0fb0
+AA_IN_STACK_RE = re.compile(r"[\u0f71]([\u0f8d-\u0fac\u0fae\u0fb0\u0fb3-\u0fbc])")
+# no 0fb0 at the end of stacks, only 0f71
+AA_END_STACK_RE = re.compile(r"[\u0fb0]([^\u0f8d-\u0fac\u0fae\u0fb0\u0fb3-\u0fbc]|$)")
+
+# All the contextual rules only involve characters that are sorted after
+# a base (category > Base), so they can be applied to each run of such
+# characters independently. A run of one character never changes, except
+# a lone 0fb0 which becomes 0f71.
+RUN_RE = re.compile("%s?%s{2,}|\u0fb0" % (BASE_CLASS, MARK_CLASS))
+
+def normalize_run(run):
+    if charcat(run[0]) == OrderCats.Base:
+        base, marks = run[0], run[1:]
+    else:
+        base, marks = "", run
+    # /!\ some fonts don't display these combinations in the exact same way
+    # but since there's no semantic distinction and the graphical variation
+    # is unclear, it seems safe
+    marks = marks.replace("\u0f7a\u0f7a", "\u0f7b")
+    marks = marks.replace("\u0f7c\u0f7c", "\u0f7d")
+    marks = AA_IN_STACK_RE.sub("\u0fb0\\1", marks)
+    marks = AA_END_STACK_RE.sub("\u0f71\\1", marks)
+    if base:
+        return sort_stack(base + marks)
+    return marks
+
+# the same runs come back all the time
+RUN_CACHE = {}
+RUN_CACHE_SIZE = 4096
+
+def normalize_run_match(m):
+    run = m.group()
+    res = RUN_CACHE.get(run)
+    if res is None:
+        res = normalize_run(run)
+        if len(RUN_CACHE) < RUN_CACHE_SIZE:
+            RUN_CACHE[run] = res
+    return res
+
+# Optional numpy backend, for big texts. numpy is only imported when it is
+# used, it takes longer to import than the rest of the code.
+
+def import_numpy():
+    ''' Returns the numpy module, or None if it is not installed'''
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+# chars that can follow 0fb0 in a stack, see AA_IN_STACK_RE and AA_END_STACK_RE
+AA_FOLLOWERS = [c for c in range(0x0F8D, 0x0FBD) if c not in [0x0FAD, 0x0FAF, 0x0FB1, 0x0FB2]]
+
+class NumpyNormalizer():
+    ''' Vectorized decompositions, normalize_run() rules and reordering, on arrays of
+    code points (uint32). decompositions is a table of str.translate() whose keys are
+    all in the Tibetan block.'''
+    def __init__(self, np, decompositions=None):
+        self.np = np
+        self.categories = np.zeros(0x100, np.uint8)
+        self.categories[:len(CATEGORIES)] = [c.value for c in CATEGORIES]
+        self.aa_followers = np.zeros(0x100, bool)
+        self.aa_followers[[c - 0x0F00 for c in AA_FOLLOWERS]] = True
+        decompositions = decompositions or {}
+        width = max([len(v) for v in decompositions.values()], default=1)
+        self.lengths = np.ones(0x100, np.intp)
+        self.expansions = np.zeros((0x100, width), np.uint32)
+        for k, v in decompositions.items():
+            assert 0x0F00 <= k < 0x0FFF
+            self.lengths[k - 0x0F00] = len(v)
+            self.expansions[k - 0x0F00, :len(v)] = [ord(c) for c in v]
+
+    def to_array(self, s):
+        return self.np.frombuffer(s.encode("utf-32-le"), self.np.uint32)
+
+    def to_str(self, a):
+        return a.tobytes().decode("utf-32-le")
+
+    def lookup(self, table, a):
+        ''' Returns table[c - 0x0F00] for the chars c of a. The chars outside of the
+        Tibetan block wrap around and get the value of 0FFF, which is not used.'''
+        return table[self.np.minimum(a - 0x0F00, 0xFF)]
+
+    def decompose(self, a):
+        np = self.np
+        lengths = self.lookup(self.lengths, a)
+        decomposed = lengths > 1
+        if not decomposed.any():
+            return a
+        # each decomposed char is repeated, then replaced by its decomposition
+        res = np.repeat(a, lengths)
+        starts = (np.cumsum(lengths) - lengths)[decomposed]
+        expansions = self.expansions[(a[decomposed] - 0x0F00)]
+        for j in range(expansions.shape[1]):
+            used = lengths[decomposed] > j
+            res[starts[used] + j] = expansions[used, j]
+        return res
+
+    def normalize(self, s):
+        ''' Same as s.translate(decompositions) followed by normalize_runs()'''
+        return self.to_str(self.normalize_runs(self.decompose(self.to_array(s))))
+
+    def normalize_runs(self, a):
+        ''' Same as RUN_RE.sub(normalize_run_match, s) on an array'''
+        np = self.np
+        a = a.copy()
+        # 0f7a 0f7a -> 0f7b, 0f7c 0f7c -> 0f7d, from left to right like str.replace()
+        keep = None
+        for c, r in [(0x0F7A, 0x0F7B), (0x0F7C, 0x0F7D)]:
+            same = a == c
+            pairs = same[:-1] & same[1:]
+            if not pairs.any():
+                continue
+            # index in the sequence of c of each c
+            idx = np.arange(len(a))
+            starts = same & ~np.concatenate(([False], same[:-1]))
+            rank = idx - np.maximum.accumulate(np.where(starts, idx, 0))
+            first = np.concatenate((pairs, [False])) & (rank % 2 == 0)
+            a[first] = r
+            second = np.concatenate(([False], first[:-1]))
+            keep = ~second if keep is None else keep & ~second
+        if keep is not None:
+            a = a[keep]
+        # no 0f71 in the middle of stacks, no 0fb0 at the end
+        followers = self.lookup(self.aa_followers, a)
+        a[:-1][(a[:-1] == 0x0F71) & followers[1:]] = 0x0FB0
+        followers = self.lookup(self.aa_followers, a)
+        a[(a == 0x0FB0) & ~np.concatenate((followers[1:], [False]))] = 0x0F71
+        return self.reorder(a)[0]
+
+    def reorder(self, a):
+        ''' Same as unicode_reorder() on an array, returns the array and valid'''
+        np = self.np
+        cats = self.lookup(self.categories, a)
+        idx = np.arange(len(a))
+        # index of the last char that is not a mark, for each char
+        marks = cats > OrderCats.Base.value
+        heads = np.maximum.accumulate(np.where(marks, -1, idx))
+        in_stack = marks & (heads >= 0) & (cats[np.maximum(heads, 0)] == OrderCats.Base.value)
+        valid = not (marks & ~in_stack).any()
+        unsorted = in_stack[1:] & (cats[1:] < cats[:-1])
+        if unsorted.any():
+            # stable sort by stack then category
+            a = a[np.lexsort((cats, np.where(in_stack, heads, idx)))]
+        return a, valid
+
+# "python" is the default, "numpy" falls back to "python" if numpy is not installed
+BACKENDS = ["python", "numpy"]
+
+NUMPY_NORMALIZERS = {}
+
+def numpy_normalizer(backend, decompositions=None):
+    ''' Returns the NumpyNormalizer of a decomposition table for the "numpy" backend,
+    None for the "python" backend or if numpy is not installed'''
+    if backend not in BACKENDS:
+        raise ValueError("backend must be one of %s" % ", ".join(BACKENDS))
+    if backend == "python":
+        return None
+    key = id(decompositions)
+    if key not in NUMPY_NORMALIZERS:
+        np = import_numpy()
+        NUMPY_NORMALIZERS[key] = NumpyNormalizer(np, decompositions) if np is not None else None
+    return NUMPY_NORMALIZERS[key]